@@ -1,10 +1,215 @@
-#%%
-import pandas as pd
+import argparse
+import csv
+import datetime
+import io
+import json
+import os
+import tempfile
+import urllib.error
+import urllib.request
 
-print("Downloading Japan")
-df = pd.read_csv("https://covid19.mhlw.go.jp/public/opendata/newly_confirmed_cases_daily.csv")
-df.to_csv("data/raw/Japan.csv", index=False)
+SOURCES = {
+    "Japan": {
+        "url": "https://covid19.mhlw.go.jp/public/opendata/newly_confirmed_cases_daily.csv",
+        "path": "data/raw/Japan.csv",
+        "date_column": "Date",
+        "group_column": None,
+    },
+    "World": {
+        "url": "https://covid.ourworldindata.org/data/owid-covid-data.csv",
+        "path": "data/raw/World.csv",
+        "date_column": "date",
+        "group_column": "location",
+    },
+}
 
-print("Downloading World")
-df = pd.read_csv("https://covid.ourworldindata.org/data/owid-covid-data.csv")
-df.to_csv("data/raw/World.csv", index=False)
+
+def parse_date(value):
+    # 厚労省は 2020/1/16、OWID は 2020-01-16 の形式
+    year, month, day = value.replace("/", "-").split("-")
+    return datetime.date(int(year), int(month), int(day))
+
+
+def meta_path(path):
+    return f"{path}.meta.json"
+
+
+def read_meta(path):
+    if not os.path.exists(meta_path(path)):
+        return {}
+    with open(meta_path(path), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_meta(path, meta):
+    tmp_path = f"{meta_path(path)}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, meta_path(path))
+
+
+class Schema:
+    def __init__(self, header, date_column, group_column):
+        self.header = header.rstrip("\r\n")
+        self.columns = next(csv.reader([self.header]))
+        if date_column not in self.columns:
+            raise ValueError(f"column {date_column!r} not found")
+        self.date_idx = self.columns.index(date_column)
+        self.group_idx = None if group_column is None else self.columns.index(group_column)
+
+    def parse(self, line):
+        # (グループ, 日付) を返す。列数が合わない行はスキーマ違反とする
+        row = next(csv.reader([line]))
+        if len(row) != len(self.columns):
+            raise ValueError(f"expected {len(self.columns)} columns, got {len(row)}: {line!r}")
+        group = "" if self.group_idx is None else row[self.group_idx]
+        return group, parse_date(row[self.date_idx])
+
+
+def scan_last_dates(path, schema):
+    # 既存ファイルを走査してグループごとの最新日付を求める
+    last_dates = {}
+    with open(path, "rb") as f:
+        f.readline()
+        for line in f:
+            line = line.decode("utf-8")
+            if not line.strip():
+                continue
+            group, date = schema.parse(line)
+            if group not in last_dates or last_dates[group] < date:
+                last_dates[group] = date
+    return last_dates
+
+
+def truncate_unfinished_append(path, meta):
+    # メタデータは追記が終わるたびに書くので、ファイルが記録より大きければ末尾は中断された追記の残り (途中で切れた行を含みうる)。
+    # 記録したサイズに切り詰め、その分の行は今回の差分として取り直す
+    recorded = meta.get("size")
+    if recorded is not None and recorded < os.path.getsize(path):
+        with open(path, "r+b") as f:
+            f.truncate(recorded)
+
+
+def load_last_dates(path, schema, meta):
+    # メタデータはファイルサイズが記録と一致するときだけ信用し、それ以外 (メタデータが無い・書き換えられた) は全体を走査する
+    if "last_dates" not in meta or meta.get("size") != os.path.getsize(path):
+        return scan_last_dates(path, schema)
+    return {i: parse_date(j) for i, j in meta["last_dates"].items()}
+
+
+def update(name, url=None, path=None, timeout=60):
+    """差分だけを追記し、追加された日付の範囲 (なければ None) を返す"""
+    source = SOURCES[name]
+    url = url or source["url"]
+    path = path or source["path"]
+    meta = read_meta(path) if os.path.exists(path) else {}
+    if os.path.exists(path):
+        truncate_unfinished_append(path, meta)
+
+    headers = {}
+    # ファイルがメタデータの記録と違えば、条件付きリクエストで古い状態のまま 304 を受け取らないようにする
+    if meta.get("url") == url and meta.get("size") == os.path.getsize(path):
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    try:
+        response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            print(f"{name}: not modified")
+            return None
+        raise
+
+    with response:
+        lines = io.TextIOWrapper(response, encoding="utf-8-sig", newline="")
+        schema = Schema(next(lines), source["date_column"], source["group_column"])
+        if os.path.exists(path):
+            with open(path, encoding="utf-8-sig", newline="") as f:
+                if f.readline().rstrip("\r\n") != schema.header:
+                    raise ValueError(f"{name}: header of {url} does not match {path}")
+            last_dates = load_last_dates(path, schema, meta)
+            changed = append_new_rows(path, lines, schema, last_dates)
+        else:
+            last_dates = {}
+            changed = download_all(path, lines, schema, last_dates)
+
+    meta = {
+        "url": url,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "last_dates": {i: j.isoformat() for i, j in last_dates.items()},
+        "changed": None if changed is None else [i.isoformat() for i in changed],
+        "size": os.path.getsize(path),
+        "updated_at": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+    write_meta(path, meta)
+    print(f"{name}: changed {meta['changed']}")
+    return changed
+
+
+def download_all(path, lines, schema, last_dates):
+    # 初回は一時ファイルに書き出してから rename する
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".download.", dir=os.path.dirname(path) or ".")
+    first = None
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            f.write(schema.header + "\n")
+            for line in lines:
+                if not line.strip():
+                    continue
+                group, date = schema.parse(line)
+                f.write(line if line.endswith("\n") else line + "\n")
+                first = date if first is None else min(first, date)
+                last_dates[group] = max(last_dates.get(group, date), date)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return None if first is None else (first, max(last_dates.values()))
+
+
+def append_new_rows(path, lines, schema, last_dates):
+    # 既存の最新日付より新しい行だけを追記する。途中で失敗したら元のサイズに切り詰める
+    size = os.path.getsize(path)
+    new_last_dates = dict(last_dates)
+    first = last = None
+    with open(path, "r+b") as f:
+        try:
+            if size > 0:
+                f.seek(size - 1)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+            f.seek(0, os.SEEK_END)
+            for line in lines:
+                if not line.strip():
+                    continue
+                group, date = schema.parse(line)
+                if group in last_dates and date <= last_dates[group]:
+                    continue
+                f.write((line if line.endswith("\n") else line + "\n").encode("utf-8"))
+                first = date if first is None else min(first, date)
+                last = date if last is None else max(last, date)
+                new_last_dates[group] = max(new_last_dates.get(group, date), date)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            f.truncate(size)
+            raise
+    last_dates.update(new_last_dates)
+    return None if first is None else (first, last)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", choices=list(SOURCES), nargs="*", default=list(SOURCES))
+    parser.add_argument("--japan_url", default=SOURCES["Japan"]["url"])
+    parser.add_argument("--world_url", default=SOURCES["World"]["url"])
+    parser.add_argument("--timeout", type=int, default=60)
+    args = parser.parse_args()
+
+    urls = {"Japan": args.japan_url, "World": args.world_url}
+    for name in args.only:
+        print(f"Updating {name}")
+        update(name, url=urls[name], timeout=args.timeout)
@@ -0,0 +1,127 @@
+import argparse
+import csv
+import glob
+import hashlib
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+RAW_DIR = "data/raw/weather"
+CACHE_DIR = "data/cache/weather"
+OUTPUT = "data/use/weather.csv"
+COLUMNAR_OUTPUT = "data/use/weather.npz"
+HEADER_ROWS = 6  # ダウンロード時刻・空行・地点・要素・副要素 (風向など)・品質情報などの 6 行
+HOURS = (7, 15)  # data/use/weather.csv は 7:00〜15:00 の日中の平均
+# 天気は気象庁の天気番号 (3 時間ごと) を、この表での順番 (0 始まり) に置き換えてから平均する
+WEATHER_CODES = [1, 2, 3, 4, 10, 11, 12, 15]  # 快晴・晴れ・薄曇・曇・雨・雨強し・にわか雨・雪
+
+
+def parse_header(rows):
+    # 地点・要素・副要素・情報の 4 行から、値そのものの列だけを (列番号, 地点, 要素) として取り出す
+    stations, elements, sub_elements, flags = rows[2:6]
+    columns = []
+    for i in range(1, len(elements)):
+        if sub_elements[i] or flags[i]:
+            continue
+        element = re.sub(r"\(.*\)$", "", elements[i])  # 単位を落とす
+        columns.append((i, stations[i], element))
+    return columns
+
+
+def parse_month(path, hours=HOURS):
+    # 気象庁の月別 CSV を読み、hours = (始め, 終わり) 時 (両端を含む) の値を平均し、地点平均した日別の DataFrame を返す
+    with open(path, encoding="cp932", newline="") as f:
+        rows = list(csv.reader(f))
+    columns = parse_header(rows)
+    body = rows[HEADER_ROWS:]
+    values = pd.DataFrame(
+        [[row[i] for i, _, _ in columns] for row in body],
+        columns=pd.MultiIndex.from_tuples([(station, element) for _, station, element in columns]),
+    )
+    # 雲量の "0+" や "10-" は記号を落として数値にする
+    values = values.apply(lambda x: pd.to_numeric(x.str.rstrip("+-"), errors="coerce"))
+    weather = values.columns.get_level_values(1) == "天気"
+    codes = values.loc[:, weather]
+    observed = codes.to_numpy().ravel()
+    unknown = set(observed[~np.isnan(observed)].astype(int)) - set(WEATHER_CODES)
+    if unknown:
+        raise ValueError(f"{path}: unknown weather codes {sorted(unknown)}; add them to WEATHER_CODES")
+    values.loc[:, weather] = codes.replace({code: k for k, code in enumerate(WEATHER_CODES)})
+    # 欠測は次の時刻の値で埋める (3 時間ごとの天気・雲量も、その時刻までの値とみなされる)
+    values = values.bfill()
+    # 1:00〜24:00 を 1 日とみなす (24:00 は翌日 0:00 と表記される)
+    timestamp = pd.to_datetime([row[0] for row in body])
+    date = (timestamp - pd.Timedelta(hours=1)).floor("D")
+    hour = (timestamp - date) // pd.Timedelta(hours=1)  # 1〜24
+    mask = np.asarray((hour >= hours[0]) & (hour <= hours[1]))
+    daily = values[mask].groupby(date[mask]).mean()
+    daily = daily.T.groupby(level=1, sort=False).mean().T  # 地点平均
+    daily.index.name = "日付"
+    return daily
+
+
+def cache_path(path, hours=HOURS):
+    stat = os.stat(path)
+    signature = f"{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}:{WEATHER_CODES}"
+    digest = hashlib.sha1(signature.encode()).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(CACHE_DIR, f"{name}-{hours[0]}-{hours[1]}-{digest}.pkl")
+
+
+def parse_month_cached(path, hours=HOURS):
+    cached = cache_path(path, hours)
+    if os.path.exists(cached):
+        return pd.read_pickle(cached)
+    daily = parse_month(path, hours)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    for old in glob.glob(cached.rsplit("-", 1)[0] + "-*.pkl"):
+        os.remove(old)
+    tmp_path = f"{cached}.{os.getpid()}.tmp"
+    daily.to_pickle(tmp_path)
+    os.replace(tmp_path, cached)
+    return daily
+
+
+def build(raw_dir=RAW_DIR, max_workers=None, hours=HOURS):
+    # キャッシュの無い月だけをプロセスプールで並列に処理する
+    paths = sorted(glob.glob(os.path.join(raw_dir, "*.csv")))
+    todo = [i for i in paths if not os.path.exists(cache_path(i, hours))]
+    if todo:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(parse_month_cached, todo, [hours] * len(todo)))
+    df = pd.concat([parse_month_cached(i, hours) for i in paths])
+    df = df.groupby(level=0).mean()  # 月をまたぐ日があれば平均する
+    return df.asfreq("D")
+
+
+def save(df, output=OUTPUT, columnar_output=COLUMNAR_OUTPUT):
+    df.to_csv(output, date_format="%Y-%m-%d")
+    arrays = {"日付": df.index.values.astype("datetime64[D]")}
+    arrays.update({column: df[column].values.astype(np.float64) for column in df})
+    tmp_path = f"{columnar_output}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, columnar_output)
+
+
+def load_weather(path=COLUMNAR_OUTPUT):
+    # 日付と各要素の配列を dict で返す (pandas を使わずに読める)
+    with np.load(path) as f:
+        return {i: f[i] for i in f.files}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--raw_dir", default=RAW_DIR)
+    parser.add_argument("--output", default=OUTPUT)
+    parser.add_argument("--columnar_output", default=COLUMNAR_OUTPUT)
+    parser.add_argument("--max_workers", type=int, default=None)
+    parser.add_argument("--hours", type=int, nargs=2, default=list(HOURS), help="平均する時間帯 (両端を含む。1〜24)")
+    args = parser.parse_args()
+
+    df = build(args.raw_dir, args.max_workers, tuple(args.hours))
+    save(df, args.output, args.columnar_output)
+    print(df)
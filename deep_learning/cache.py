@@ -0,0 +1,59 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+CACHE_DIR = "data/cache"
+
+
+def source_signature(path):
+    # 元データの更新 (mtime・サイズ) でキーが変わるようにする
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def cache_key(prefix, sources, **kwargs):
+    # 引数ごとにエントリを分け、元データの署名はハッシュにして末尾に付ける
+    name = "_".join([prefix] + [f"{k}={v}" for k, v in sorted(kwargs.items())])
+    digest = hashlib.sha1("\n".join(source_signature(i) for i in sources).encode()).hexdigest()[:16]
+    return f"{name}-{digest}"
+
+
+def load(key, cache_dir=CACHE_DIR):
+    # mmap_mode="c" で開くので複数プロセスで同じページを共有し、書き込みは各プロセスに閉じる
+    path = os.path.join(cache_dir, key)
+    if not os.path.isdir(path):
+        return None
+    with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="c") for name in meta["arrays"]}
+    return arrays, meta
+
+
+def save(key, arrays, meta, cache_dir=CACHE_DIR):
+    # 一時ディレクトリに書き出してから rename し、読み手に書きかけの状態を見せない
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix=f".{key}.", dir=cache_dir)
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), np.ascontiguousarray(array))
+        with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({**meta, "arrays": list(arrays)}, f, ensure_ascii=False)
+        os.rename(tmp_path, os.path.join(cache_dir, key))
+    except OSError:
+        # 同じキーを他のプロセスが先に書き終えた場合はそちらを使う
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(os.path.join(cache_dir, key)):
+            raise
+    prune(key, cache_dir)
+
+
+def prune(key, cache_dir=CACHE_DIR):
+    # 同じ引数で元データだけが古いエントリを消す
+    prefix = key.rsplit("-", 1)[0] + "-"
+    for name in os.listdir(cache_dir):
+        if name.startswith(prefix) and name != key:
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
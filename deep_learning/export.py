@@ -0,0 +1,69 @@
+import argparse
+import json
+import warnings
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from main import load_model, quantization_report
+from predict import OUTPUT, meta_path
+from utils import SOURCES, InverseScaler, get_test_dataloader
+
+
+class Forecaster(nn.Module):
+    # 標準化済みの直近 X_seq 週 [N, X_seq] から t_seq 週先までを予測する (デコーダの先頭は窓の最後の値)
+    def __init__(self, net, t_seq):
+        super().__init__()
+        self.net = net
+        self.t_seq = t_seq
+
+    def forward(self, enc_x):
+        return self.net.forecast(enc_x, enc_x[:, -1:], [self.t_seq])[self.t_seq]  # [N, t_seq]
+
+
+def export(net, scaler, location2id, mode, X_seq, t_seq, step=None, path=OUTPUT):
+    # 予測の経路 (forecast) を TorchScript に trace して保存し、scaler の統計量と地域名・前処理の引数を .npz に書く
+    # 地域の数 (バッチサイズ) は trace 後も可変
+    net = net.cpu().eval()
+    example = torch.zeros(len(location2id), X_seq)
+    # torch.export は forecast 内の torch.no_grad を扱えないので TorchScript を使う
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", FutureWarning)
+        traced = torch.jit.trace(Forecaster(net, t_seq), example, check_trace=False)
+        torch.jit.save(traced, path)
+    config = {"mode": mode, "source": SOURCES[mode], "X_seq": X_seq, "t_seq": t_seq, "step": step}
+    np.savez(
+        meta_path(path),
+        mean=np.asarray(scaler.mean_, dtype=np.float64),
+        scale=np.asarray(scaler.scale_, dtype=np.float64),
+        locations=np.array(sorted(location2id, key=location2id.get)),
+        config=np.array(json.dumps(config)),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", required=True, help="main.py --save_model で保存したモデル")
+    parser.add_argument("--output", default=OUTPUT)
+    parser.add_argument("--quantize", action="store_true", help="LSTM と Linear を動的 int8 量子化して書き出す")
+    parser.add_argument("--max_rmse_delta", type=float, default=None, help="量子化による test RMSE の悪化の上限")
+    args = parser.parse_args()
+
+    net, _, scaler, state = load_model(args.model)
+    # 窓の長さなどの前処理の引数は学習時に保存した値を使う
+    config = state["config"]
+    if args.quantize:
+        # 量子化前後を test の窓で比べ、悪化が上限を超えたら書き出さない。窓は保存した scaler で標準化する
+        test_dataloader = get_test_dataloader(
+            config["X_seq"], config["t_seq"], config["mode"], 4096, scaler, state["location2id"], config["step"], loader="tensor"
+        )
+        report, net = quantization_report(net, test_dataloader, InverseScaler(scaler, "cpu"))
+        print(
+            f"int8 test RMSE {report['int8']['rmse']:.3f} ({report['rmse_delta']:+.3f}) | "
+            f"MAE {report['int8']['mae']:.3f} ({report['mae_delta']:+.3f}) | speedup {report['speedup']:.2f}x"
+        )
+        if args.max_rmse_delta is not None and report["rmse_delta"] > args.max_rmse_delta:
+            raise SystemExit(f"RMSE delta {report['rmse_delta']:.3f} exceeds --max_rmse_delta {args.max_rmse_delta}")
+    export(net, scaler, state["location2id"], config["mode"], config["X_seq"], config["t_seq"], config["step"], args.output)
+    print(f"exported {args.output} and {meta_path(args.output)}")
@@ -1,16 +1,35 @@
 import argparse
+import json
 import os
+import time
 
 import matplotlib.pyplot as plt
 import numpy as np
 import seaborn as sns
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.nn.functional as F
 import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
 from tqdm.auto import tqdm
 
 import nets
-from utils import DEVICE, EarlyStopping, get_dataloader, inverse_scaler
+from utils import (
+    DEVICE,
+    CheckpointManager,
+    EarlyStopping,
+    EnsembleEarlyStopping,
+    InverseScaler,
+    Metrics,
+    get_dataloader,
+    get_incremental_dataloader,
+    init_distributed,
+    is_distributed,
+    load_preprocessed,
+    load_scaler,
+    set_epoch,
+)
 
 sns.set()
 torch.manual_seed(555)
@@ -19,104 +38,286 @@ torch.backends.cudnn.benchmark = False
 
 def train(net, optimizer, dataloader, scaler):
     net.train()
-    rmse = 0.0
-    mae = 0.0
+    metrics = Metrics(dataloader.dataset.location_num)
     for enc_X, dec_X, t, location in dataloader:
-        enc_X = enc_X.to(DEVICE)
-        dec_X = dec_X.to(DEVICE)
-        t = t.to(DEVICE)
+        enc_X = enc_X.to(DEVICE, non_blocking=True)
+        dec_X = dec_X.to(DEVICE, non_blocking=True)
+        t = t.to(DEVICE, non_blocking=True)
         optimizer.zero_grad()
         y = net(enc_X, dec_X)
         batch_loss = F.mse_loss(y, t) ** 0.5
         batch_loss.backward()
         optimizer.step()
         if scaler is None:
-            rmse += ((y - t) ** 2).sum().detach().item()
-            mae += F.l1_loss(y, t, reduction="sum").detach().item()
+            metrics.update(y, t, location)
         else:
-            location_num = dataloader.dataset.location_num
-            y_inverse = inverse_scaler(y, location, location_num, scaler)
-            t_inverse = inverse_scaler(t, location, location_num, scaler)
-            rmse += ((y_inverse - t_inverse) ** 2).sum()
-            mae += abs(y_inverse - t_inverse).sum()
-    rmse = (rmse / dataloader.dataset.size) ** 0.5
-    mae = mae / dataloader.dataset.size
-    return rmse, mae
+            metrics.update(scaler(y, location), scaler(t, location), location)
+    if is_distributed():
+        # 学習の sampler は rank 間でバッチ数をそろえるため先頭の窓を繰り返すので、窓の数が world_size で割り切れないと
+        # 数個の窓が 2 回数えられる。学習中の目安としては許容し、val・test は重複しない sampler で正確に集計する
+        metrics.all_reduce()
+    result = metrics.compute()
+    return result["rmse"], result["mae"]
 
 
-def val_test(net, dataloader, scaler, is_test):
+def ensemble_interval(y, interval):
+    # y: [K, N, T] メンバー間の分位点を予測区間とする
+    q = torch.tensor([(1 - interval) / 2, (1 + interval) / 2], dtype=y.dtype, device=y.device)
+    lower, upper = torch.quantile(y, q, dim=0)  # [N, T], [N, T]
+    return lower, upper
+
+
+def val_test(net, dataloader, scaler, is_test, interval=None, device=DEVICE):
+    # interval を指定すると (EnsembleNet のみ)、メンバー間の予測区間の被覆率と平均幅も返す
+    # 量子化したモデルは CPU でしか動かないので device で実行先を変えられる
+    if interval is not None and not isinstance(net, nets.EnsembleNet):
+        raise ValueError("interval requires an EnsembleNet")
     net.eval()
-    rmse = 0.0
-    mae = 0.0
-    y_all = []
-    t_all = []
+    metrics = Metrics(dataloader.dataset.location_num, device=device)
+    covered = width = 0.0
     with torch.no_grad():
         for enc_X, dec_X, t, location in dataloader:
-            enc_X = enc_X.to(DEVICE)
-            dec_X = dec_X.to(DEVICE)
-            t = t.to(DEVICE)
+            enc_X = enc_X.to(device, non_blocking=True)
+            dec_X = dec_X.to(device, non_blocking=True)
+            t = t.to(device, non_blocking=True)
             if is_test:
                 y = net.test(enc_X, dec_X, t.shape[-1])
             else:
                 y = net(enc_X, dec_X)
-            if scaler is None:
-                rmse += ((y - t) ** 2).sum().item()
-                mae += F.l1_loss(y, t, reduction="sum").detach().item()
-                y_all += y.cpu().numpy().reshape(-1).tolist()
-                t_all += t.cpu().numpy().reshape(-1).tolist()
-            else:
-                location_num = dataloader.dataset.location_num
-                y_inverse = inverse_scaler(y, location, location_num, scaler)
-                t_inverse = inverse_scaler(t, location, location_num, scaler)
-                rmse += ((y_inverse - t_inverse) ** 2).sum()
-                mae += abs(y_inverse - t_inverse).sum()
-                y_all += y_inverse.tolist()
-                t_all += t_inverse.tolist()
-    rmse = (rmse / dataloader.dataset.size) ** 0.5
-    mae = mae / dataloader.dataset.size
-    if is_test:
-        corrcoef = np.corrcoef(np.array([y_all, t_all]))[0][1]
-    else:
-        corrcoef = None
-    return rmse, mae, corrcoef
+            if scaler is not None:
+                y = scaler(y, location)
+                t = scaler(t, location)
+            if isinstance(net, nets.EnsembleNet):
+                # メンバーの平均を点予測とする
+                if interval is not None:
+                    lower, upper = ensemble_interval(y, interval)
+                    covered += ((lower <= t) & (t <= upper)).sum()
+                    width += (upper - lower).sum()
+                y = y.mean(0)
+            metrics.update(y, t, location)
+    if is_distributed():
+        metrics.all_reduce()
+    result = metrics.compute()
+    corrcoef = result["corrcoef"] if is_test else None
+    if interval is None:
+        return result["rmse"], result["mae"], corrcoef
+    count = result["count"]
+    return result["rmse"], result["mae"], corrcoef, {"coverage": float(covered) / count, "width": float(width) / count}
+
+
+def quantization_report(net, dataloader, scaler):
+    # 動的 int8 量子化の前後で test の窓を CPU 上の val_test に通し、RMSE・MAE の差と速度比を返す
+    float_net = net.cpu().eval()
+    quantized_net = nets.quantize(float_net)
+    result = {}
+    for name, model in [("float", float_net), ("int8", quantized_net)]:
+        val_test(model, dataloader, scaler, is_test=True, device="cpu")  # ウォームアップ
+        start = time.perf_counter()
+        rmse, mae, _ = val_test(model, dataloader, scaler, is_test=True, device="cpu")
+        result[name] = {"rmse": float(rmse), "mae": float(mae), "seconds": time.perf_counter() - start}
+    net.to(DEVICE)
+    result["rmse_delta"] = result["int8"]["rmse"] - result["float"]["rmse"]
+    result["mae_delta"] = result["int8"]["mae"] - result["float"]["mae"]
+    result["speedup"] = result["float"]["seconds"] / result["int8"]["seconds"]
+    return result, quantized_net
+
+
+def train_ensemble(net, optimizer, dataloader, scaler, active):
+    # メンバーごとの RMSE の和を逆伝播する。パラメータはメンバー間で独立なので、各メンバーは自分の損失の勾配だけを受け取る
+    # 早期終了したメンバー (active が False) の損失は足さない
+    net.train()
+    metrics = [Metrics(dataloader.dataset.location_num) for _ in range(net.num_members)]
+    active = torch.as_tensor(active, dtype=torch.float32, device=DEVICE)  # [K]
+    for enc_X, dec_X, t, location in dataloader:
+        enc_X = enc_X.to(DEVICE, non_blocking=True)
+        dec_X = dec_X.to(DEVICE, non_blocking=True)
+        t = t.to(DEVICE, non_blocking=True)
+        optimizer.zero_grad()
+        y = net(enc_X, dec_X)  # [K, N, t_seq]
+        batch_loss = ((y - t) ** 2).mean(dim=(1, 2)) ** 0.5  # [K]
+        (batch_loss * active).sum().backward()
+        optimizer.step()
+        if scaler is not None:
+            y = scaler(y, location)
+            t = scaler(t, location)
+        for k in range(net.num_members):
+            metrics[k].update(y[k], t, location)
+    results = [i.compute() for i in metrics]
+    return np.array([i["rmse"] for i in results]), np.array([i["mae"] for i in results])
+
+
+def val_ensemble(net, dataloader, scaler):
+    # メンバーごとの val の RMSE・MAE を返す
+    net.eval()
+    metrics = [Metrics(dataloader.dataset.location_num) for _ in range(net.num_members)]
+    with torch.no_grad():
+        for enc_X, dec_X, t, location in dataloader:
+            enc_X = enc_X.to(DEVICE, non_blocking=True)
+            dec_X = dec_X.to(DEVICE, non_blocking=True)
+            t = t.to(DEVICE, non_blocking=True)
+            y = net(enc_X, dec_X)  # [K, N, t_seq]
+            if scaler is not None:
+                y = scaler(y, location)
+                t = scaler(t, location)
+            for k in range(net.num_members):
+                metrics[k].update(y[k], t, location)
+    results = [i.compute() for i in metrics]
+    return np.array([i["rmse"] for i in results]), np.array([i["mae"] for i in results])
+
+
+# optuna
+BEST_PARAMS = {
+    "transformer": {
+        "d_model": 84,
+        "nhead": 1,
+        "num_encoder_layers": 5,
+        "num_decoder_layers": 1,
+        "dim_feedforward": 2048,
+        "dropout": 0.6996650500967093,
+    },
+    "lstm": {"d_model": 459, "num_layers": 5, "dropout": 0.6722579147817102, "bidirectional": True},
+}
+
+
+def build_net(net_name, max_len, params=None):
+    params = {**BEST_PARAMS[net_name], **(params or {})}
+    if net_name == "transformer":
+        net = nets.TransformerNet(**params, max_len=max_len).to(DEVICE)
+    elif net_name == "lstm":
+        net = nets.LSTMNet(**params).to(DEVICE)
+    return net
 
 
-def run(train_dataloader, val_dataloader, total_epoch, patience, batch_size, net_name, scaler):
+def build_ensemble(net_name, max_len, num_members, params=None, seed=555):
+    # シードだけを変えた num_members 個のモデルを作り、パラメータを積んだ EnsembleNet にまとめる
+    members = []
+    for k in range(num_members):
+        torch.manual_seed(seed + k)
+        members.append(build_net(net_name, max_len, params))
+    return nets.EnsembleNet(members).to(DEVICE)
+
+
+def save_model(path, net_name, max_len, net, optimizer, scaler, location2id, n_weeks, config, params=None):
+    # 増分学習で再開できるよう、モデル・optimizer と固定する scaler の統計量をまとめて保存する
+    # config は前処理の引数 {"mode", "X_seq", "t_seq", "step"} で、増分学習と書き出しはこの値を使う
+    torch.save(
+        {
+            "net_name": net_name,
+            "max_len": max_len,
+            "config": config,
+            "params": params,
+            "net": net.state_dict(),
+            "optimizer": optimizer.state_dict(),
+            "scaler": {name: np.asarray(getattr(scaler, name)) for name in ["mean_", "var_", "scale_", "n_samples_seen_"]},
+            "location2id": location2id,
+            "n_weeks": n_weeks,
+        },
+        path,
+    )
+
+
+def load_model(path):
+    state = torch.load(path, map_location="cpu", weights_only=False)
+    net = build_net(state["net_name"], state["max_len"], state.get("params"))
+    net.load_state_dict(state["net"])
+    optimizer = optim.AdamW(net.parameters(), lr=1e-5)
+    optimizer.load_state_dict(state["optimizer"])
+    scaler = load_scaler({f"scaler_{name}": value for name, value in state["scaler"].items()})
+    return net, optimizer, scaler, state
+
+
+def run(
+    train_dataloader,
+    val_dataloader,
+    total_epoch,
+    patience,
+    net_name,
+    scaler,
+    checkpoint_dir=None,
+    resume=False,
+    net=None,
+    optimizer=None,
+):
     train_loss_list = []
     train_mae_list = []
     val_loss_list = []
     val_mae_list = []
-    early_stopping = EarlyStopping(patience)
-    if net_name == "transformer":
-        # optuna
-        net = nets.TransformerNet(
-            d_model=84,
-            nhead=1,
-            num_encoder_layers=5,
-            num_decoder_layers=1,
-            dim_feedforward=2048,
-            dropout=0.6996650500967093,
-            batch_size=batch_size,
-        ).to(DEVICE)
-    elif net_name == "lstm":
-        # optuna
-        net = nets.LSTMNet(d_model=459, num_layers=5, dropout=0.6722579147817102, bidirectional=True).to(DEVICE)
-    optimizer = optim.AdamW(net.parameters(), lr=1e-5)
-    pbar = tqdm(total=total_epoch, position=0)
-    desc = tqdm(total=total_epoch, position=1, bar_format="{desc}", desc="")
-    for epoch in range(total_epoch):
-        train_loss, train_mae = train(net, optimizer, train_dataloader, scaler)
+    # 分散学習時は全 rank が同じ値で早期終了を判定し、チェックポイントの書き出しは rank 0 だけが行う
+    rank = dist.get_rank() if is_distributed() else 0
+    checkpoint = CheckpointManager(checkpoint_dir, resume=resume) if checkpoint_dir is not None and rank == 0 else None
+    early_stopping = EarlyStopping(patience, checkpoint)
+    if net is None:
+        net = build_net(
+            net_name, max(train_dataloader.dataset.enc_X.shape[-1], train_dataloader.dataset.t.shape[-1])
+        )
+    if optimizer is None:
+        optimizer = optim.AdamW(net.parameters(), lr=1e-5)
+    start_epoch = 0
+    if resume and checkpoint_dir is not None:
+        # 最良のチェックポイントの時点から学習を再開する。分散学習時は rank 0 が読んだものを全 rank に配る
+        state = checkpoint.best() if checkpoint is not None else None
+        if state is not None:
+            state["history"] = checkpoint.history(state["epoch"])
+        if is_distributed():
+            objects = [state]
+            dist.broadcast_object_list(objects, src=0)
+            state = objects[0]
+        if state is not None:
+            net.load_state_dict(state["net"])
+            optimizer.load_state_dict(state["optimizer"])
+            train_loss_list, val_loss_list, train_mae_list, val_mae_list = [
+                [i[k] for i in state["history"]] for k in ["train_loss", "val_loss", "train_mae", "val_mae"]
+            ]
+            start_epoch = state["epoch"] + 1
+            early_stopping.best_value = state["value"]
+            early_stopping.checkpoint.snapshot(net, optimizer)
+    # 勾配の all-reduce は DDP のラッパーで行い、評価と保存はラップしていない net で行う
+    model = DistributedDataParallel(net) if is_distributed() else net
+    pbar = tqdm(total=total_epoch, initial=start_epoch, position=0, disable=rank != 0)
+    desc = tqdm(total=total_epoch, position=1, bar_format="{desc}", desc="", disable=rank != 0)
+    for epoch in range(start_epoch, total_epoch):
+        set_epoch(train_dataloader, epoch)
+        train_loss, train_mae = [float(i) for i in train(model, optimizer, train_dataloader, scaler)]
         train_loss_list.append(train_loss)
         train_mae_list.append(train_mae)
         val_loss, val_mae, _ = val_test(net, val_dataloader, scaler, is_test=False)
+        val_loss, val_mae = float(val_loss), float(val_mae)
         val_loss_list.append(val_loss)
         val_mae_list.append(val_mae)
         pbar.update(1)
-        if early_stopping(net, val_loss):
+        if checkpoint is not None:
+            checkpoint.log(epoch, train_loss=train_loss, val_loss=val_loss, train_mae=train_mae, val_mae=val_mae)
+        if early_stopping(net, val_loss, optimizer, epoch=epoch):
             break
         desc_str = f"Train RMSE: {train_loss:.3f} | Val RMSE: {val_loss:.3f} | Train MAE: {train_mae:.3f} | Val MAE: {val_mae:.3f} | Best Val RMSE: {early_stopping.best_value:.3f} | EaryStopping Counter: {early_stopping.counter}/{early_stopping.patience}"
         desc.set_description(desc_str)
     net.load_state_dict(early_stopping.best_state_dict)
+    early_stopping.checkpoint.close()
+    return train_loss_list, val_loss_list, train_mae_list, val_mae_list, net
+
+
+def run_ensemble(train_dataloader, val_dataloader, total_epoch, patience, scaler, net, optimizer):
+    # run() のアンサンブル版。損失の履歴はメンバーの平均を残す
+    train_loss_list = []
+    train_mae_list = []
+    val_loss_list = []
+    val_mae_list = []
+    early_stopping = EnsembleEarlyStopping(patience, net.num_members)
+    pbar = tqdm(total=total_epoch, position=0)
+    desc = tqdm(total=total_epoch, position=1, bar_format="{desc}", desc="")
+    for epoch in range(total_epoch):
+        train_loss, train_mae = train_ensemble(net, optimizer, train_dataloader, scaler, early_stopping.active)
+        val_loss, val_mae = val_ensemble(net, val_dataloader, scaler)
+        train_loss_list.append(float(train_loss.mean()))
+        train_mae_list.append(float(train_mae.mean()))
+        val_loss_list.append(float(val_loss.mean()))
+        val_mae_list.append(float(val_mae.mean()))
+        pbar.update(1)
+        if early_stopping(net, val_loss):
+            break
+        desc_str = f"Train RMSE: {train_loss_list[-1]:.3f} | Val RMSE: {val_loss_list[-1]:.3f} | Best Val RMSE: {early_stopping.best_value.mean():.3f} | Active: {early_stopping.active.sum()}/{net.num_members}"
+        desc.set_description(desc_str)
+    net.load_state_dict(early_stopping.best_state_dict)
     return train_loss_list, val_loss_list, train_mae_list, val_mae_list, net
 
 
@@ -135,53 +336,92 @@ def plot_history(train_loss_list, val_loss_list, train_mae_list, val_mae_list):
     plt.savefig("deep_learning/result/mae.png")
 
 
-def plot_predict(net, dataloader, location2id, scaler, mode):
-    X, _, t, _ = dataloader.dataset[0]
-    X_seq = len(X)
-    t_seq = len(t)
-    y_all_location = []
-    t_all_location = []
+def predict_all(net, dataset, scaler, batch_size=4096, interval=0.9):
+    # データセット全体を大きなバッチで 1 回だけ net.test に通し、[location_num, 窓の数, t_seq] の配列に書き込む
+    # データセットは窓ごとに全地域が並んでいるので、先頭からの位置を location_num で割れば窓の番号になる
+    # EnsembleNet のときはメンバーの平均を y とし、メンバー間の予測区間を lower・upper に書き込む
+    net.eval()
+    location_num = dataset.location_num
+    window_num = len(dataset) // location_num
+    X_seq = dataset.enc_X.shape[-1]
+    t_seq = dataset.t.shape[-1]
+    dtype = torch.float32 if scaler is None else scaler.mean.dtype
+    y_all = torch.zeros(location_num, window_num, t_seq, dtype=dtype, device=DEVICE)
+    t_all = torch.zeros(location_num, window_num, t_seq, dtype=dtype, device=DEVICE)
+    enc_first = torch.zeros(location_num, X_seq, dtype=dtype, device=DEVICE)
+    is_ensemble = isinstance(net, nets.EnsembleNet)
+    if is_ensemble:
+        lower_all = torch.zeros_like(y_all)
+        upper_all = torch.zeros_like(y_all)
+    metrics = Metrics(location_num)
+    with torch.no_grad():
+        for start in range(0, len(dataset), batch_size):
+            enc_X, dec_X, t, location = dataset[start : start + batch_size]
+            enc_X = enc_X.to(DEVICE, non_blocking=True)
+            dec_X = dec_X.to(DEVICE, non_blocking=True)
+            t = t.to(DEVICE, non_blocking=True)
+            location = location.to(DEVICE, non_blocking=True)
+            window = torch.arange(start, start + len(t), device=DEVICE) // location_num
+            y = net.test(enc_X, dec_X, t.shape[-1])
+            if scaler is not None:
+                y = scaler(y, location)
+                t = scaler(t, location)
+                enc_X = scaler(enc_X, location)
+            if is_ensemble:
+                lower, upper = ensemble_interval(y, interval)
+                lower_all[location, window] = lower.to(dtype)
+                upper_all[location, window] = upper.to(dtype)
+                y = y.mean(0)
+            metrics.update(y, t, location)
+            y_all[location, window] = y.to(dtype)
+            t_all[location, window] = t.to(dtype)
+            is_first = window == 0
+            enc_first[location[is_first]] = enc_X[is_first].to(dtype)
+    result = {
+        "y": y_all.cpu().numpy(),
+        "t": t_all.cpu().numpy(),
+        "enc_first": enc_first.cpu().numpy(),
+        "mae": metrics.compute()["mae_per_location"],
+    }
+    if is_ensemble:
+        result["lower"] = lower_all.cpu().numpy()
+        result["upper"] = upper_all.cpu().numpy()
+    return result
+
+
+def plot_predict(net, dataloader, location2id, scaler, mode, step=None, interval=0.9):
+    result = predict_all(net, dataloader.dataset, scaler, interval=interval)
+    _, window_num, t_seq = result["y"].shape
+    X_seq = result["enc_first"].shape[-1]
+    step = t_seq if step is None else step
     for location_str, location_id in tqdm(location2id.items(), leave=False):
-        net.eval()
-        y_each_location = []
-        t_each_location = []
-        cnt = 0
-        is_first = True
-        with torch.no_grad():
-            for enc_X, dec_X, t, location in dataloader:
-                enc_X = enc_X[location == location_id]
-                dec_X = dec_X[location == location_id]
-                t = t[location == location_id]
-                location = location[location == location_id]
-                location_num = dataloader.dataset.location_num
-                if len(t) == 0:
-                    continue
-                if is_first:
-                    if scaler is None:
-                        t_each_location += enc_X[[0]].numpy().reshape(-1).tolist()
-                    else:
-                        t_each_location += inverse_scaler(enc_X[[0]], location[[0]], location_num, scaler).tolist()
-                    is_first = False
-                enc_X = enc_X.to(DEVICE)
-                dec_X = dec_X.to(DEVICE)
-                t = t.to(DEVICE)
-                y = net.test(enc_X, dec_X, t.shape[-1])
-                y_all_location += y.cpu().numpy().reshape(-1).tolist()
-                t_all_location += t.cpu().numpy().reshape(-1).tolist()
-                if scaler is None:
-                    y_each_location += y.cpu().numpy().reshape(-1).tolist()
-                    t_each_location += t.cpu().numpy().reshape(-1).tolist()
-                else:
-                    y_each_location += inverse_scaler(y, location, location_num, scaler).tolist()
-                    t_each_location += inverse_scaler(t, location, location_num, scaler).tolist()
-                cnt += len(y_each_location)
-        mae = abs(np.array(y_each_location) - np.array(t_each_location[X_seq:])).sum()
-        mae /= cnt
+        y_each_location = result["y"][location_id]  # [窓の数, t_seq]
+        # step > t_seq のときの窓の間の日は正解が無いので、0 ではなく NaN にして線を切る
+        t_each_location = np.full(X_seq + (window_num - 1) * step + t_seq, np.nan)
+        t_each_location[:X_seq] = result["enc_first"][location_id]
+        for i in range(window_num):
+            t_each_location[X_seq + i * step : X_seq + i * step + t_seq] = result["t"][location_id, i]
+        mae = result["mae"][location_id]
         fig, ax = plt.subplots()
-        for i in range(0, len(y_each_location), t_seq):
+        for i in range(window_num):
+            begin = X_seq + i * step
             if i > 0:
-                ax.plot(range(X_seq + i - 1, X_seq + i + 1), y_each_location[i - 1 : i + 1], color="C0", linestyle="--")
-            ax.plot(range(X_seq + i, X_seq + i + t_seq), y_each_location[i : i + t_seq], color="C0")
+                ax.plot(
+                    [begin - step + t_seq - 1, begin],
+                    [y_each_location[i - 1, -1], y_each_location[i, 0]],
+                    color="C0",
+                    linestyle="--",
+                )
+            ax.plot(range(begin, begin + t_seq), y_each_location[i], color="C0")
+            if "lower" in result:
+                ax.fill_between(
+                    range(begin, begin + t_seq),
+                    result["lower"][location_id, i],
+                    result["upper"][location_id, i],
+                    color="C0",
+                    alpha=0.2,
+                    linewidth=0,
+                )
         ax.lines[0].set_label("predict")
         ax.plot(t_each_location, label="ground truth", color="C1")
         ax.legend()
@@ -190,39 +430,189 @@ def plot_predict(net, dataloader, location2id, scaler, mode):
         plt.close(fig)
 
 
+def main(rank, args):
+    world_size = args.workers
+    if world_size > 1:
+        init_distributed(rank, world_size, args.threads, master_port=args.master_port)
+    train_dataloader, val_dataloader, test_dataloader, scaler, location2id = get_dataloader(
+        X_seq=args.X_seq,
+        t_seq=args.t_seq,
+        use_val=True,
+        mode=args.mode,
+        batch_size=args.batch_size,
+        step=args.step,
+        loader=args.loader,
+        device=DEVICE if args.data_on_device else None,
+        pin_memory=args.pin_memory,
+        use_cache=not args.no_cache,
+        rank=rank,
+        world_size=world_size,
+    )
+    # 位置エンコーディングと因果マスクは forecast で展開する最大の horizon まで作っておく
+    max_len = max(args.X_seq, args.t_seq, args.max_horizon or 0)
+    standard_scaler = scaler
+    scaler = InverseScaler(scaler, DEVICE) if args.use_inverse else None
+
+    if args.ensemble > 1:
+        net = build_ensemble(args.net, max_len, args.ensemble, args.params)
+        optimizer = optim.AdamW(net.parameters(), lr=args.lr)
+        train_loss_list, val_loss_list, train_mae_list, val_mae_list, net = run_ensemble(
+            train_dataloader, val_dataloader, args.total_epoch, args.patience, scaler, net, optimizer
+        )
+    else:
+        net = build_net(args.net, max_len, args.params)
+        optimizer = optim.AdamW(net.parameters(), lr=args.lr)
+        train_loss_list, val_loss_list, train_mae_list, val_mae_list, net = run(
+            train_dataloader=train_dataloader,
+            val_dataloader=val_dataloader,
+            total_epoch=args.total_epoch,
+            patience=args.patience,
+            net_name=args.net,
+            scaler=scaler,
+            checkpoint_dir=args.checkpoint_dir,
+            resume=args.resume,
+            net=net,
+            optimizer=optimizer,
+        )
+    if rank == 0 and args.save_model is not None:
+        arrays, _ = load_preprocessed(args.X_seq, args.t_seq, True, args.mode, args.step, not args.no_cache)
+        save_model(
+            args.save_model,
+            args.net,
+            max_len,
+            net,
+            optimizer,
+            standard_scaler,
+            location2id,
+            len(arrays["weekly"]),
+            {"mode": args.mode, "X_seq": args.X_seq, "t_seq": args.t_seq, "step": args.step},
+            args.params,
+        )
+    if rank == 0:
+        plot_history(train_loss_list, val_loss_list, train_mae_list, val_mae_list)
+
+    # 評価は各 rank が受け持つ窓で行い、Metrics を all-reduce して全体の値にする
+    interval = args.interval if args.ensemble > 1 else None
+    for name, dataloader in [("Train", train_dataloader), ("Test", test_dataloader)]:
+        result = val_test(net, dataloader, scaler, is_test=True, interval=interval)
+        loss, mae, corrcoef = result[:3]
+        if rank == 0:
+            tqdm.write(f"{name} RMSE: {loss:.3f} | {name} MAE: {mae:.3f} | {name} Corr Coef: {corrcoef:.3f}")
+            if interval is not None:
+                tqdm.write(f"{name} {interval:.0%} Interval Coverage: {result[3]['coverage']:.3f} | Width: {result[3]['width']:.3f}")
+
+    if rank == 0 and args.quantize:
+        report, _ = quantization_report(net, test_dataloader, scaler)
+        tqdm.write(
+            f"Int8 Test RMSE: {report['int8']['rmse']:.3f} ({report['rmse_delta']:+.3f}) | "
+            f"Int8 Test MAE: {report['int8']['mae']:.3f} ({report['mae_delta']:+.3f}) | Speedup: {report['speedup']:.2f}x"
+        )
+
+    if rank == 0:
+        plot_predict(net, train_dataloader, location2id, scaler, os.path.join(args.mode, "train"), args.step, args.interval)
+        plot_predict(net, test_dataloader, location2id, scaler, args.mode, args.step, args.interval)
+    if world_size > 1:
+        dist.destroy_process_group()
+
+
+def incremental(args):
+    # --incremental: 保存したモデルと scaler を読み込み、追加された週で fine-tune して保存し直す
+    net, optimizer, scaler, state = load_model(args.incremental)
+    location2id = state["location2id"]
+    # 前処理の引数は保存したモデルのものを使う (--mode などの既定値で別のデータを読み、0 埋めの窓で学習しないように)
+    config = state["config"]
+    train_dataloader, val_dataloader, n_weeks = get_incremental_dataloader(
+        X_seq=config["X_seq"],
+        t_seq=config["t_seq"],
+        mode=config["mode"],
+        batch_size=args.batch_size,
+        scaler=scaler,
+        location2id=location2id,
+        prev_weeks=state["n_weeks"],
+        step=config["step"],
+        replay=args.replay,
+        val_windows=args.val_windows,
+        loader=args.loader,
+        device=DEVICE if args.data_on_device else None,
+        pin_memory=args.pin_memory,
+    )
+    inverse_scaler = InverseScaler(scaler, DEVICE) if args.use_inverse else None
+    net = net.to(DEVICE)
+    old_loss, old_mae, corrcoef = val_test(net, val_dataloader, inverse_scaler, is_test=True)
+    tqdm.write(f"Old RMSE: {old_loss:.3f} | Old MAE: {old_mae:.3f} | Old Corr Coef: {corrcoef:.3f}")
+    run(
+        train_dataloader=train_dataloader,
+        val_dataloader=val_dataloader,
+        total_epoch=args.finetune_epochs,
+        patience=args.patience,
+        net_name=state["net_name"],
+        scaler=inverse_scaler,
+        net=net,
+        optimizer=optimizer,
+    )
+    save_model(
+        args.save_model or args.incremental,
+        state["net_name"],
+        state["max_len"],
+        net,
+        optimizer,
+        scaler,
+        location2id,
+        n_weeks,
+        config,
+        state.get("params"),
+    )
+    new_loss, new_mae, corrcoef = val_test(net, val_dataloader, inverse_scaler, is_test=True)
+    tqdm.write(f"New RMSE: {new_loss:.3f} | New MAE: {new_mae:.3f} | New Corr Coef: {corrcoef:.3f}")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--mode", choices=["World", "Japan", "Tokyo"], default="World")
     parser.add_argument("--X_seq", type=int, default=10)
     parser.add_argument("--t_seq", type=int, default=4)
+    parser.add_argument("--step", type=int, default=None)
     parser.add_argument("--total_epoch", type=int, default=100000)
     parser.add_argument("--patience", type=int, default=50)
     parser.add_argument("--batch_size", type=int, default=32)
     parser.add_argument("--use_inverse", action="store_true")
     parser.add_argument("--net", default="transformer")
+    parser.add_argument("--lr", type=float, default=1e-5)
+    parser.add_argument("--params", type=json.loads, default=None, help="BEST_PARAMS を上書きする JSON")
+    parser.add_argument("--loader", choices=["torch", "tensor"], default="torch")
+    parser.add_argument("--pin_memory", action="store_true")
+    parser.add_argument("--data_on_device", action="store_true")
+    parser.add_argument("--no_cache", action="store_true")
+    parser.add_argument("--checkpoint_dir", default=None)
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--save_model", default=None)
+    parser.add_argument("--max_horizon", type=int, default=None, help="保存したモデルの forecast で予測する最大の週数 (既定は t_seq)")
+    parser.add_argument("--incremental", default=None, help="前回 --save_model で保存したモデルから増分学習する (--mode・--X_seq・--t_seq・--step は保存時の値を使う)")
+    parser.add_argument("--finetune_epochs", type=int, default=200)
+    parser.add_argument("--replay", type=float, default=4.0)
+    parser.add_argument("--val_windows", type=int, default=1, help="増分学習で val にする最新の新しい窓の数")
+    parser.add_argument("--workers", type=int, default=1, help="gloo バックエンドで CPU のデータ並列学習をするプロセス数")
+    parser.add_argument("--threads", type=int, default=None, help="各プロセスのスレッド数 (既定はコア数 / workers)")
+    parser.add_argument("--master_port", type=int, default=29500)
+    parser.add_argument("--ensemble", type=int, default=1, help="シードを変えたモデルの数。2 以上で 1 回の vmap でまとめて学習する")
+    parser.add_argument("--interval", type=float, default=0.9, help="アンサンブルの予測区間の幅")
+    parser.add_argument("--quantize", action="store_true", help="学習後に動的 int8 量子化した CPU 推論の精度と速度を比べる")
     args = parser.parse_args()
+    if args.incremental is not None and args.workers > 1:
+        parser.error("--incremental does not support --workers")
+    if args.ensemble > 1 and (
+        args.workers > 1 or args.incremental or args.checkpoint_dir or args.resume or args.save_model
+    ):
+        parser.error("--ensemble does not support --workers, --incremental, --checkpoint_dir, --resume or --save_model")
+    if args.ensemble > 1 and args.quantize:
+        parser.error("--quantize does not support --ensemble")
 
-    train_dataloader, val_dataloader, test_dataloader, scaler, location2id = get_dataloader(
-        X_seq=args.X_seq, t_seq=args.t_seq, use_val=True, mode=args.mode, batch_size=args.batch_size
-    )
-    if not args.use_inverse:
-        scaler = None
-
-    train_loss_list, val_loss_list, train_mae_list, val_mae_list, net = run(
-        train_dataloader=train_dataloader,
-        val_dataloader=val_dataloader,
-        total_epoch=args.total_epoch,
-        patience=args.patience,
-        batch_size=args.batch_size,
-        net_name=args.net,
-        scaler=scaler,
-    )
-    plot_history(train_loss_list, val_loss_list, train_mae_list, val_mae_list)
-
-    train_loss, train_mae, corrcoef = val_test(net, train_dataloader, scaler, is_test=True)
-    tqdm.write(f"Train RMSE: {train_loss:.3f} | Train MAE: {train_mae:.3f} | Train Corr Coef: {corrcoef:.3f}")
-    test_loss, test_mae, corrcoef = val_test(net, test_dataloader, scaler, is_test=True)
-    tqdm.write(f"Test RMSE: {test_loss:.3f} | Test MAE: {test_mae:.3f} | Test Corr Coef: {corrcoef:.3f}")
-
-    plot_predict(net, train_dataloader, location2id, scaler, os.path.join(args.mode, "train"))
-    plot_predict(net, test_dataloader, location2id, scaler, args.mode)
+    if args.incremental is not None:
+        incremental(args)
+    elif args.workers > 1:
+        # 前処理のキャッシュを先に作っておき、各 rank はそれを memmap で開く
+        if not args.no_cache:
+            load_preprocessed(args.X_seq, args.t_seq, True, args.mode, args.step)
+        mp.spawn(main, args=(args,), nprocs=args.workers)
+    else:
+        main(0, args)
@@ -1,7 +1,11 @@
+import copy
 import math
+import warnings
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.func import functional_call, stack_module_state, vmap
 
 
 class PositionalEncoding(nn.Module):
@@ -11,16 +15,74 @@ class PositionalEncoding(nn.Module):
 
         position = torch.arange(max_len).unsqueeze(1)
         div_term = torch.exp(torch.arange(0, d_model, 2) * (-math.log(10000.0) / d_model))
-        pe = torch.zeros(max_len, 1, d_model)
-        pe[:, 0, 0::2] = torch.sin(position * div_term)
-        pe[:, 0, 1::2] = torch.cos(position * div_term)
+        pe = torch.zeros(max_len, d_model)
+        pe[:, 0::2] = torch.sin(position * div_term)
+        pe[:, 1::2] = torch.cos(position * div_term)
         self.register_buffer("pe", pe)
 
-    def forward(self, x):
-        x = x + self.pe[: x.size(0)]
+    def forward(self, x, offset=0):
+        # x: [N, L, d_model] (batch_first)。offset は逐次デコード時の先頭の位置
+        x = x + self.pe[offset : offset + x.size(1)]
         return self.dropout(x)
 
 
+def _in_projection(attn, x, i):
+    # MultiheadAttention の in_proj から q (i=0)・k (i=1)・v (i=2) の射影だけを取り出して適用する
+    d_model = attn.embed_dim
+    weight = attn.in_proj_weight[i * d_model : (i + 1) * d_model]
+    bias = None if attn.in_proj_bias is None else attn.in_proj_bias[i * d_model : (i + 1) * d_model]
+    x = F.linear(x, weight, bias)  # [N, L, d_model]
+    return x.unflatten(-1, (attn.num_heads, -1)).transpose(1, 2)  # [N, nhead, L, d_model / nhead]
+
+
+def _attend(attn, q, k, v):
+    y = F.scaled_dot_product_attention(q, k, v)  # [N, nhead, 1, d_model / nhead]
+    y = y.transpose(1, 2).flatten(-2)  # [N, 1, d_model]
+    return attn.out_proj(y)
+
+
+class DecoderCache:
+    # デコーダ各層の self-attention の key/value と、エンコーダ出力に対する cross-attention の key/value を保持する
+    def __init__(self, decoder, memory, t_seq):
+        self.length = 0
+        self.self_kv = []
+        self.cross_kv = []
+        for layer in decoder.layers:
+            attn = layer.self_attn
+            shape = [memory.shape[0], attn.num_heads, t_seq, attn.embed_dim // attn.num_heads]
+            self.self_kv.append([memory.new_empty(shape), memory.new_empty(shape)])
+            attn = layer.multihead_attn
+            self.cross_kv.append([_in_projection(attn, memory, 1), _in_projection(attn, memory, 2)])
+
+    def self_attention(self, i, attn, x):
+        # 新しいトークンの key/value だけを計算してバッファに書き込み、これまでの全トークンに注意する
+        k_cache, v_cache = self.self_kv[i]
+        k_cache[:, :, self.length] = _in_projection(attn, x, 1)[:, :, 0]
+        v_cache[:, :, self.length] = _in_projection(attn, x, 2)[:, :, 0]
+        q = _in_projection(attn, x, 0)
+        return _attend(attn, q, k_cache[:, :, : self.length + 1], v_cache[:, :, : self.length + 1])
+
+    def cross_attention(self, i, attn, x):
+        return _attend(attn, _in_projection(attn, x, 0), *self.cross_kv[i])
+
+
+def _decoder_step(decoder, x, cache):
+    # x: [N, 1, d_model] 最新のトークンだけを各層に通す
+    for i, layer in enumerate(decoder.layers):
+        if layer.norm_first:
+            x = x + layer.dropout1(cache.self_attention(i, layer.self_attn, layer.norm1(x)))
+            x = x + layer.dropout2(cache.cross_attention(i, layer.multihead_attn, layer.norm2(x)))
+            x = x + layer._ff_block(layer.norm3(x))
+        else:
+            x = layer.norm1(x + layer.dropout1(cache.self_attention(i, layer.self_attn, x)))
+            x = layer.norm2(x + layer.dropout2(cache.cross_attention(i, layer.multihead_attn, x)))
+            x = layer.norm3(x + layer._ff_block(x))
+    cache.length += 1
+    if decoder.norm is not None:
+        x = decoder.norm(x)
+    return x
+
+
 class TransformerNet(nn.Module):
     def __init__(
         self,
@@ -30,12 +92,14 @@ class TransformerNet(nn.Module):
         num_decoder_layers=6,
         dim_feedforward=2048,
         dropout=0.1,
-        batch_size=512,
+        max_len=512,
     ):
         super().__init__()
         self.l1 = nn.Linear(1, d_model)
         self.l2 = nn.Linear(1, d_model)
-        self.positional_encoder = PositionalEncoding(d_model, max_len=batch_size)
+        self.positional_encoder = PositionalEncoding(d_model, max_len=max_len)
+        # 系列長ごとに作り直さないよう、最大長の因果マスクを一度だけ作って切り出して使う
+        self.register_buffer("tgt_mask", nn.Transformer.generate_square_subsequent_mask(max_len), persistent=False)
         self.transformer = nn.Transformer(
             d_model,
             nhead,
@@ -48,7 +112,7 @@ class TransformerNet(nn.Module):
         self.l3 = nn.Linear(d_model, 1)
 
     def forward(self, enc_x, dec_x):
-        mask = nn.Transformer.generate_square_subsequent_mask(dec_x.shape[-1]).cuda()
+        mask = self.tgt_mask[: dec_x.shape[-1], : dec_x.shape[-1]]
         enc_x = enc_x.unsqueeze(-1)  # [N, x_seq, 1]
         enc_x = self.l1(enc_x)  # [N, x_seq, d_model]
         enc_x = self.positional_encoder(enc_x)
@@ -59,7 +123,9 @@ class TransformerNet(nn.Module):
         y = self.l3(y).squeeze(-1)  # [N, t_seq]
         return y
 
-    def test(self, enc_x, dec_x, t_seq):
+    def test(self, enc_x, dec_x, t_seq, use_cache=True):
+        if use_cache:
+            return self.test_cached(enc_x, dec_x, t_seq)
         dec_x = dec_x[:, [0]]  # [N, 1]
         with torch.no_grad():
             encoder = self.transformer.encoder
@@ -72,11 +138,69 @@ class TransformerNet(nn.Module):
                 dec_x2 = dec_x.unsqueeze(-1)  # [N, i, 1]
                 dec_x2 = self.l2(dec_x2)  # [N, i, d_model]
                 dec_x2 = self.positional_encoder(dec_x2)  # [N, i, d_model]
-                y = decoder(dec_x2, enc_y)  # [N, i, d_model]
+                y = decoder(dec_x2, enc_y, tgt_mask=self.tgt_mask[:i, :i])  # [N, i, d_model]
                 y = self.l3(y).squeeze(-1)  # [N, 1]
                 dec_x = torch.cat([dec_x, y[:, [-1]]], dim=-1)  # [N, i + 1]
         return dec_x[:, 1:]
 
+    def test_cached(self, enc_x, dec_x, t_seq):
+        return self.forecast(enc_x, dec_x, [t_seq])[t_seq]
+
+    def forecast(self, enc_x, dec_x, horizons, out=None):
+        # 最大の horizon まで 1 回だけ展開して [N, max(horizons)] のバッファに書き込み、horizon ごとに先頭部分を返す
+        # エンコーダ出力と cross-attention の key/value は 1 回だけ計算し、各ステップでは最新のトークンだけをデコーダに通す
+        horizon = max(horizons)
+        max_len = self.tgt_mask.shape[0]
+        if horizon > max_len:
+            raise ValueError(f"horizon {horizon} exceeds max_len {max_len}; build the net with a larger max_len (main.py --max_horizon)")
+        if out is None:
+            out = dec_x.new_empty(dec_x.shape[0], horizon)  # [N, horizon]
+        with torch.no_grad():
+            enc_x = enc_x.unsqueeze(-1)  # [N, x_seq, 1]
+            enc_x = self.l1(enc_x)  # [N, x_seq, d_model]
+            enc_x = self.positional_encoder(enc_x)
+            memory = self.transformer.encoder(enc_x)  # [N, x_seq, d_model]
+            cache = DecoderCache(self.transformer.decoder, memory, horizon)
+            y_i = dec_x[:, [0]]  # [N, 1]
+            for i in range(horizon):
+                dec_x2 = self.l2(y_i.unsqueeze(-1))  # [N, 1, d_model]
+                dec_x2 = self.positional_encoder(dec_x2, offset=i)  # [N, 1, d_model]
+                dec_y = _decoder_step(self.transformer.decoder, dec_x2, cache)  # [N, 1, d_model]
+                y_i = self.l3(dec_y).squeeze(-1)  # [N, 1]
+                out[:, i] = y_i[:, 0]
+        return {h: out[:, :h] for h in horizons}
+
+
+def _lstm(lstm, x, hc=None):
+    # nn.LSTM (batch_first) と同じ計算を行列積と要素ごとの演算だけで行う。torch.func.vmap は aten::lstm を扱えないため
+    # x: [N, L, input_size]
+    num_directions = 2 if lstm.bidirectional else 1
+    shape = [lstm.num_layers * num_directions, x.shape[0], lstm.hidden_size]
+    h0, c0 = (x.new_zeros(shape), x.new_zeros(shape)) if hc is None else hc
+    h_n, c_n = [], []
+    for layer in range(lstm.num_layers):
+        outputs = []
+        for direction in range(num_directions):
+            suffix = f"_l{layer}_reverse" if direction == 1 else f"_l{layer}"
+            w_hh = getattr(lstm, f"weight_hh{suffix}")
+            b_hh = getattr(lstm, f"bias_hh{suffix}")
+            gates_x = F.linear(x, getattr(lstm, f"weight_ih{suffix}"), getattr(lstm, f"bias_ih{suffix}"))  # [N, L, 4 * H]
+            h = h0[layer * num_directions + direction]  # [N, H]
+            c = c0[layer * num_directions + direction]  # [N, H]
+            ys = [None] * x.shape[1]
+            for i in reversed(range(x.shape[1])) if direction == 1 else range(x.shape[1]):
+                i_gate, f_gate, g_gate, o_gate = (gates_x[:, i] + F.linear(h, w_hh, b_hh)).chunk(4, dim=-1)
+                c = torch.sigmoid(f_gate) * c + torch.sigmoid(i_gate) * torch.tanh(g_gate)
+                h = torch.sigmoid(o_gate) * torch.tanh(c)
+                ys[i] = h
+            outputs.append(torch.stack(ys, dim=1))  # [N, L, H]
+            h_n.append(h)
+            c_n.append(c)
+        x = torch.cat(outputs, dim=-1)  # [N, L, num_directions * H]
+        if layer < lstm.num_layers - 1:
+            x = F.dropout(x, lstm.dropout, lstm.training)
+    return x, (torch.stack(h_n), torch.stack(c_n))
+
 
 class LSTMNet(nn.Module):
     def __init__(self, d_model=512, num_layers=1, dropout=0.1, bidirectional=False):
@@ -90,27 +214,107 @@ class LSTMNet(nn.Module):
             d_model, d_model, num_layers, dropout=dropout, bidirectional=bidirectional, batch_first=True
         )
         self.l3 = nn.Linear(2 * d_model, 1) if bidirectional else nn.Linear(d_model, 1)
+        self.unrolled = False  # True のとき nn.LSTM の代わりに _lstm を使う (EnsembleNet 用)
+
+    def run_lstm(self, lstm, x, hc=None):
+        if self.unrolled:
+            return _lstm(lstm, x, hc)
+        return lstm(x, hc)
 
     def forward(self, enc_x, dec_x):
         enc_x = enc_x.unsqueeze(-1)  # [N, x_seq, 1]
         enc_x = self.l1(enc_x)  # [N, x_seq, d_model]
-        _, hc = self.enc_lstm(enc_x)
+        _, hc = self.run_lstm(self.enc_lstm, enc_x)
         dec_x = dec_x.unsqueeze(-1)  # [N, t_seq, 1]
         dec_x = self.l2(dec_x)  # [N, t_seq, d_model]
-        y, _ = self.dec_lstm(dec_x, hc)  # [N, t_seq, d_model]
+        y, _ = self.run_lstm(self.dec_lstm, dec_x, hc)  # [N, t_seq, d_model]
         y = self.l3(y).squeeze(-1)  # [N, t_seq]
         return y
 
+    def encode(self, enc_x):
+        enc_x = enc_x.unsqueeze(-1)  # [N, x_seq, 1]
+        enc_x = self.l1(enc_x)  # [N, x_seq, d_model]
+        _, hc = self.enc_lstm(enc_x)
+        return hc
+
     def test(self, enc_x, dec_x, t_seq):
-        dec_x = dec_x[:, [0]]  # [N, 1]
+        return self.forecast(enc_x, dec_x, [t_seq])[t_seq]
+
+    def forecast(self, enc_x, dec_x, horizons, out=None, hc=None, return_state=False):
+        # 最大の horizon まで 1 回だけ展開して [N, max(horizons)] のバッファに書き込み、horizon ごとに先頭部分を返す
+        # hc を渡すとエンコードを省き、前回の展開の続きから予測する
+        horizon = max(horizons)
+        if out is None:
+            out = dec_x.new_empty(dec_x.shape[0], horizon)  # [N, horizon]
         with torch.no_grad():
-            enc_x = enc_x.unsqueeze(-1)  # [N, x_seq, 1]
-            enc_x = self.l1(enc_x)  # [N, x_seq, d_model]
-            _, hc = self.enc_lstm(enc_x)
-            for i in range(1, t_seq + 1):
-                dec_x2 = dec_x[:, [-1]].unsqueeze(-1)  # [N, 1, 1]
-                dec_x2 = self.l2(dec_x2)  # [N, 1, d_model]
-                y, hc = self.dec_lstm(dec_x2, hc)  # [N, i, d_model], ...
-                y = self.l3(y).squeeze(-1)  # [N, 1]
-                dec_x = torch.cat([dec_x, y[:, [-1]]], dim=-1)  # [N, i + 1]
-        return dec_x[:, 1:]
+            if hc is None:
+                hc = self.encode(enc_x)
+            y_i = dec_x[:, [0]]  # [N, 1]
+            for i in range(horizon):
+                dec_x2 = self.l2(y_i.unsqueeze(-1))  # [N, 1, d_model]
+                y, hc = self.dec_lstm(dec_x2, hc)  # [N, 1, d_model], ...
+                y_i = self.l3(y).squeeze(-1)  # [N, 1]
+                out[:, i] = y_i[:, 0]
+        y = {h: out[:, :h] for h in horizons}
+        if return_state:
+            return y, hc
+        return y
+
+
+class EnsembleNet(nn.Module):
+    # 同じ構造の K 個のモデルのパラメータを先頭の次元に積んで持ち、torch.func.vmap で 1 回の forward/backward にまとめる
+    # バッファ (位置エンコーディング・因果マスク) は全メンバーで共通なので積まずに渡す
+    def __init__(self, members):
+        super().__init__()
+        self.num_members = len(members)
+        params, _ = stack_module_state(members)
+        self.stacked = copy.deepcopy(members[0])  # 直接は呼ばず、functional_call の入れ物として使う
+        for name, param in params.items():
+            module_name, _, param_name = name.rpartition(".")
+            setattr(self.stacked.get_submodule(module_name), param_name, nn.Parameter(param))  # [K, ...]
+        if isinstance(self.stacked, LSTMNet):
+            self.stacked.unrolled = True
+        self._template = [members[0]]  # test 用の 1 メンバー分の入れ物 (サブモジュールとしては登録しない)
+
+    def forward(self, enc_x, dec_x):
+        params = dict(self.stacked.named_parameters())
+        buffers = dict(self.stacked.named_buffers())
+
+        def call(member_params, enc_x, dec_x):
+            return functional_call(self.stacked, (member_params, buffers), (enc_x, dec_x))
+
+        return vmap(call, in_dims=(0, None, None), randomness="different")(params, enc_x, dec_x)  # [K, N, t_seq]
+
+    def member(self, k):
+        # k 番目のメンバーを通常のモデルとして取り出す
+        template = self._template[0]
+        param = next(self.parameters())
+        template.to(param.device).train(self.training)
+        with torch.no_grad():
+            for name, value in template.named_parameters():
+                value.copy_(self.stacked.get_parameter(name)[k])
+        return template
+
+    def test(self, enc_x, dec_x, t_seq):
+        # 逐次デコードは各モデルの test (KV キャッシュなど) をそのまま使い、メンバーごとに回す
+        return torch.stack([self.member(k).test(enc_x, dec_x, t_seq) for k in range(self.num_members)])  # [K, N, t_seq]
+
+
+def quantize(net):
+    # LSTM と Linear の重みを int8 にする動的量子化 (CPU 推論用)。活性化のスケールは実行時に決める
+    # MultiheadAttention の in_proj・out_proj は対象外なので、Transformer では主に feedforward 層が量子化される
+    net = copy.deepcopy(net).cpu().eval()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # torch.ao.quantization の非推奨の警告
+        net = torch.ao.quantization.quantize_dynamic(net, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+    # nn.TransformerEncoderLayer の fast path は linear1.weight などをテンソルとして読むが、量子化した Linear では weight が
+    # メソッドなので落ちる (nhead が奇数のときだけはその前に fast path から外れる)
+    # フックが付いた層は fast path を使わないので、何もしないフックを付けて通常の経路で計算させる
+    for module in net.modules():
+        if isinstance(module, nn.TransformerEncoderLayer):
+            module.register_forward_pre_hook(_no_fast_path)
+    return net
+
+
+def _no_fast_path(module, args):
+    return None
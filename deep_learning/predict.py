@@ -0,0 +1,105 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+import torch
+
+import cache
+
+OUTPUT = "deep_learning/result/forecast.pt"
+
+
+def meta_path(path):
+    return os.path.splitext(path)[0] + ".npz"
+
+
+def load(path=OUTPUT):
+    # export.py が書き出した TorchScript のモデルと、scaler の統計量・地域名・前処理の引数を読む
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", FutureWarning)  # torch.jit の非推奨の警告
+        model = torch.jit.load(path, map_location="cpu")
+    with np.load(meta_path(path)) as f:
+        meta = {name: f[name] for name in f.files}
+    config = json.loads(meta.pop("config").item())
+    return model, meta, config
+
+
+def preprocess_kwargs(config):
+    return {"X_seq": config["X_seq"], "t_seq": config["t_seq"], "use_val": True, "step": config["step"]}
+
+
+def data_key(config):
+    # 元データの mtime・サイズが変わるとキーも変わる
+    return cache.cache_key(config["mode"], [config["source"]], **preprocess_kwargs(config))
+
+
+def latest_weekly(config):
+    # 前処理キャッシュの weekly.npy ([T, 地域]) を memmap で開く
+    # 元データが更新されてキャッシュが無いときだけ、pandas を使う前処理をやり直す
+    kwargs = preprocess_kwargs(config)
+    key = data_key(config)
+    cached = cache.load(key)
+    if cached is None:
+        from utils import load_preprocessed
+
+        load_preprocessed(mode=config["mode"], **kwargs)
+        cached = cache.load(key)
+    arrays, meta = cached
+    return arrays["weekly"], arrays["dates"], meta["location2id"]
+
+
+def align_locations(weekly, location2id, locations):
+    # 週次データ [T, 地域] の列を locations の並びにそろえる (新しい地域は使わず、無くなった地域は 0 とする)
+    columns = np.array([location2id.get(i, -1) for i in locations])
+    return np.where(columns >= 0, weekly[:, np.maximum(columns, 0)], 0.0)
+
+
+def predict(model, meta, config, weekly, dates, location2id):
+    # 全地域の直近 X_seq 週を 1 つのバッチにまとめて予測し、元のスケールの [地域, t_seq] と予測する週の日付を返す
+    # 書き出し時の地域の並びにそろえる
+    window = align_locations(weekly[-config["X_seq"] :], location2id, meta["locations"])  # [X_seq, 地域]
+    enc_x = ((window - meta["mean"]) / meta["scale"]).T.astype(np.float32)  # [地域, X_seq]
+    with torch.no_grad():
+        y = model(torch.from_numpy(enc_x)).numpy()  # [地域, t_seq]
+    y = y * meta["scale"][:, None] + meta["mean"][:, None]
+    forecast_dates = dates[-1] + np.arange(1, config["t_seq"] + 1) * np.timedelta64(7, "D")
+    return y, forecast_dates
+
+
+def write_csv(f, locations, y, forecast_dates):
+    writer = csv.writer(f)
+    writer.writerow(["location"] + [str(i) for i in forecast_dates])
+    for location, values in zip(locations, y):
+        writer.writerow([location] + [f"{i:.3f}" for i in values])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=OUTPUT)
+    parser.add_argument("--output", default=None, help="省略すると標準出力に書く")
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    start = time.perf_counter()
+    model, meta, config = load(args.model)
+    weekly, dates, location2id = latest_weekly(config)
+    loaded = time.perf_counter()
+    y, forecast_dates = predict(model, meta, config, weekly, dates, location2id)
+    predicted = time.perf_counter()
+
+    if args.output is None:
+        write_csv(sys.stdout, meta["locations"], y, forecast_dates)
+    else:
+        with open(args.output, "w", encoding="utf-8", newline="") as f:
+            write_csv(f, meta["locations"], y, forecast_dates)
+    print(
+        f"load: {(loaded - start) * 1000:.1f} ms | predict: {(predicted - loaded) * 1000:.1f} ms",
+        file=sys.stderr,
+    )
@@ -0,0 +1,243 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sqlite3
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import torch
+import torch.optim as optim
+
+from main import build_net, train, val_test
+from utils import EarlyStopping, InverseScaler, get_dataloader, load_preprocessed
+
+
+def sample_params(net_name, rng):
+    # run() の "# optuna" の値を探したときの探索空間
+    if net_name == "transformer":
+        nhead = int(rng.choice([1, 2, 4, 8]))
+        return {
+            # PositionalEncoding が sin・cos を交互に並べるので d_model は偶数、かつ nhead で割り切れる必要がある
+            "d_model": 2 * nhead * int(rng.integers(4, 129 // (2 * nhead) + 4)),
+            "nhead": nhead,
+            "num_encoder_layers": int(rng.integers(1, 7)),
+            "num_decoder_layers": int(rng.integers(1, 7)),
+            "dim_feedforward": int(rng.choice([256, 512, 1024, 2048])),
+            "dropout": float(rng.uniform(0.0, 0.8)),
+            "lr": float(10 ** rng.uniform(-6, -3)),
+        }
+    elif net_name == "lstm":
+        return {
+            "d_model": int(rng.integers(16, 513)),
+            "num_layers": int(rng.integers(1, 6)),
+            "dropout": float(rng.uniform(0.0, 0.8)),
+            "bidirectional": bool(rng.integers(0, 2)),
+            "lr": float(10 ** rng.uniform(-6, -3)),
+        }
+
+
+def connect(storage):
+    conn = sqlite3.connect(storage, timeout=60, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS trials ("
+        "id INTEGER PRIMARY KEY, study TEXT, params TEXT, state TEXT, value REAL, started REAL, finished REAL)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS intermediate ("
+        "trial_id INTEGER, epoch INTEGER, value REAL, PRIMARY KEY (trial_id, epoch))"
+    )
+    return conn
+
+
+class MedianPruner:
+    # 同じ epoch までの他の試行の最良値の中央値より悪ければ打ち切る
+    def __init__(self, warmup_epochs=10, min_trials=5):
+        self.warmup_epochs = warmup_epochs
+        self.min_trials = min_trials
+
+    def should_prune(self, conn, study, trial_id, epoch, best_value):
+        if epoch < self.warmup_epochs:
+            return False
+        rows = conn.execute(
+            "SELECT MIN(i.value) FROM intermediate i JOIN trials t ON i.trial_id = t.id "
+            "WHERE t.study = ? AND i.trial_id != ? AND i.epoch <= ? GROUP BY i.trial_id HAVING MAX(i.epoch) >= ?",
+            (study, trial_id, epoch, epoch),
+        ).fetchall()
+        if len(rows) < self.min_trials:
+            return False
+        return best_value > np.median([i[0] for i in rows])
+
+
+class ASHAPruner:
+    # 非同期 successive halving: min_epochs * eta^k の各段で、その段に到達した試行の上位 1/eta に入らなければ打ち切る
+    def __init__(self, min_epochs=10, eta=3):
+        self.min_epochs = min_epochs
+        self.eta = eta
+
+    def should_prune(self, conn, study, trial_id, epoch, best_value):
+        rung = self.min_epochs
+        while rung < epoch + 1:
+            rung *= self.eta
+        if epoch + 1 != rung:
+            return False
+        rows = conn.execute(
+            "SELECT MIN(i.value) FROM intermediate i JOIN trials t ON i.trial_id = t.id "
+            "WHERE t.study = ? AND i.epoch < ? GROUP BY i.trial_id HAVING MAX(i.epoch) >= ?",
+            (study, rung, rung - 1),
+        ).fetchall()
+        values = sorted(i[0] for i in rows)
+        k = len(values) // self.eta
+        if k == 0:
+            return False
+        return best_value > values[k - 1]
+
+
+PRUNERS = {"median": MedianPruner, "asha": ASHAPruner}
+
+
+def init_worker(threads):
+    # 1 コア 1 プロセスで動かすので、各プロセスのスレッド数を固定する
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+
+def run_trial(trial_id, args):
+    conn = connect(args["storage"])
+    params = json.loads(conn.execute("SELECT params FROM trials WHERE id = ?", (trial_id,)).fetchone()[0])
+    conn.execute("UPDATE trials SET state = 'RUNNING', started = ? WHERE id = ?", (time.time(), trial_id))
+    conn.execute("DELETE FROM intermediate WHERE trial_id = ?", (trial_id,))
+    torch.manual_seed(trial_id)
+    try:
+        state, value = train_trial(conn, trial_id, params, args)
+    except Exception:
+        # 1 つの試行の失敗 (メモリ不足・組み合わせられないパラメータなど) で探索全体を止めず、FAIL として残す
+        traceback.print_exc()
+        state, value = "FAIL", None
+    conn.execute(
+        "UPDATE trials SET state = ?, value = ?, finished = ? WHERE id = ?", (state, value, time.time(), trial_id)
+    )
+    conn.close()
+    return trial_id, state, value
+
+
+def train_trial(conn, trial_id, params, args):
+    study = args["study"]
+    # 前処理済みの窓はキャッシュを memmap で開き、loader="torch" の Dataset はバッチごとにそこから読むので、
+    # 全ワーカーで同じページを共有する (loader="tensor" は float32 の複製をワーカーごとに作ってしまう)
+    train_dataloader, val_dataloader, _, scaler, _ = get_dataloader(
+        X_seq=args["X_seq"],
+        t_seq=args["t_seq"],
+        use_val=True,
+        mode=args["mode"],
+        batch_size=args["batch_size"],
+        step=args["step"],
+        loader="torch",
+    )
+    scaler = InverseScaler(scaler) if args["use_inverse"] else None
+    net_params = {k: v for k, v in params.items() if k != "lr"}
+    net = build_net(args["net"], max(args["X_seq"], args["t_seq"]), net_params)
+    optimizer = optim.AdamW(net.parameters(), lr=params["lr"])
+    pruner = PRUNERS[args["pruner"]]()
+    early_stopping = EarlyStopping(args["patience"])
+    state = "COMPLETE"
+    for epoch in range(args["total_epoch"]):
+        train(net, optimizer, train_dataloader, scaler)
+        val_loss = float(val_test(net, val_dataloader, scaler, is_test=False)[0])
+        conn.execute("INSERT OR REPLACE INTO intermediate VALUES (?, ?, ?)", (trial_id, epoch, val_loss))
+        stop = early_stopping(net, val_loss)
+        if pruner.should_prune(conn, study, trial_id, epoch, early_stopping.best_value):
+            state = "PRUNED"
+            break
+        if stop:
+            break
+    return state, early_stopping.best_value
+
+
+def search(args):
+    conn = connect(args["storage"])
+    study = args["study"]
+    # 途中で落ちた試行は同じパラメータでやり直す
+    conn.execute("UPDATE trials SET state = 'WAITING' WHERE study = ? AND state = 'RUNNING'", (study,))
+    done = conn.execute(
+        "SELECT COUNT(*) FROM trials WHERE study = ? AND state IN ('COMPLETE', 'PRUNED', 'FAIL')", (study,)
+    ).fetchone()[0]
+    waiting = conn.execute("SELECT COUNT(*) FROM trials WHERE study = ? AND state = 'WAITING'", (study,)).fetchone()[0]
+    rng = np.random.default_rng([args["seed"], done + waiting])
+    for _ in range(max(0, args["n_trials"] - done - waiting)):
+        params = json.dumps(sample_params(args["net"], rng))
+        conn.execute("INSERT INTO trials (study, params, state) VALUES (?, ?, 'WAITING')", (study, params))
+    trial_ids = [
+        i[0] for i in conn.execute("SELECT id FROM trials WHERE study = ? AND state = 'WAITING'", (study,)).fetchall()
+    ]
+
+    # 先に 1 回だけ前処理してキャッシュを作っておく
+    load_preprocessed(args["X_seq"], args["t_seq"], True, args["mode"], args["step"])
+    n_workers = args["n_workers"] or os.cpu_count()
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        n_workers, mp_context=context, initializer=init_worker, initargs=(args["threads"],)
+    ) as executor:
+        futures = {executor.submit(run_trial, i, args): i for i in trial_ids}
+        for future in as_completed(futures):
+            try:
+                trial_id, state, value = future.result()
+            except Exception as e:
+                # ワーカーのプロセスごと落ちたときは、実行中だった試行を FAIL にして残りを続ける
+                trial_id, state, value = futures[future], "FAIL", None
+                conn.execute(
+                    "UPDATE trials SET state = 'FAIL', finished = ? WHERE id = ? AND state = 'RUNNING'",
+                    (time.time(), trial_id),
+                )
+                print(f"trial {trial_id}: {e!r}")
+            print(f"trial {trial_id}: {state}" + ("" if value is None else f" {value:.4f}"))
+    return best_trial(conn, study)
+
+
+def best_trial(conn, study):
+    row = conn.execute(
+        "SELECT id, params, value FROM trials WHERE study = ? AND state = 'COMPLETE' ORDER BY value LIMIT 1", (study,)
+    ).fetchone()
+    if row is None:
+        return None
+    return {"id": row[0], "params": json.loads(row[1]), "value": row[2]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["World", "Japan", "Tokyo"], default="World")
+    parser.add_argument("--X_seq", type=int, default=10)
+    parser.add_argument("--t_seq", type=int, default=4)
+    parser.add_argument("--step", type=int, default=None)
+    parser.add_argument("--total_epoch", type=int, default=1000)
+    parser.add_argument("--patience", type=int, default=50)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--use_inverse", action="store_true")
+    parser.add_argument("--net", choices=["transformer", "lstm"], default="transformer")
+    parser.add_argument("--n_trials", type=int, default=100)
+    parser.add_argument("--n_workers", type=int, default=None)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--pruner", choices=list(PRUNERS), default="median")
+    parser.add_argument("--storage", default="deep_learning/result/search.sqlite3")
+    parser.add_argument("--study", default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = vars(parser.parse_args())
+    args["study"] = args["study"] or f"{args['net']}_{args['mode']}_X{args['X_seq']}_t{args['t_seq']}"
+
+    best = search(args)
+    print(f"best: {json.dumps(best)}")
+    if best is not None:
+        params = {k: v for k, v in best["params"].items() if k != "lr"}
+        # 探索したときと同じデータ・窓で学習し直すコマンド
+        command = (
+            f"python deep_learning/main.py --net {args['net']} --mode {args['mode']} "
+            f"--X_seq {args['X_seq']} --t_seq {args['t_seq']}"
+        )
+        if args["step"] is not None:
+            command += f" --step {args['step']}"
+        if args["use_inverse"]:
+            command += " --use_inverse"
+        print(f"{command} --lr {best['params']['lr']} --params '{json.dumps(params)}'")
@@ -0,0 +1,209 @@
+import argparse
+import collections
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import torch
+
+import predict
+
+
+class MicroBatcher:
+    # リクエストをキューに貯め、max_batch_size 個そろうか最初のリクエストから max_latency 秒たったら 1 回の forward にまとめる
+    def __init__(self, model, max_batch_size=64, max_latency=0.005):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.histogram = collections.Counter()  # {バッチサイズ: 回数}
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, enc_x):
+        # enc_x: [X_seq] 標準化済みの窓。結果 ([t_seq]) は Future で返す
+        future = Future()
+        self.queue.put((enc_x, future))
+        return future
+
+    def _collect(self):
+        items = [self.queue.get()]
+        deadline = time.monotonic() + self.max_latency
+        while len(items) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                items.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return items
+
+    def _loop(self):
+        while True:
+            items = self._collect()
+            enc_x = torch.from_numpy(np.stack([i[0] for i in items]).astype(np.float32))  # [B, X_seq]
+            try:
+                with torch.no_grad():
+                    y = self.model(enc_x).numpy()  # [B, t_seq]
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+            else:
+                for (_, future), y_i in zip(items, y):
+                    future.set_result(y_i)
+            self.histogram[len(items)] += 1
+
+
+class ForecastService:
+    # export.py のモデルを 1 回だけ読み、地域ごとの予測を (地域, 基準の週) 単位でキャッシュする
+    # 元データが更新される (前処理キャッシュのキーが変わる) と窓を読み直してキャッシュを捨てる
+    # load_data は (weekly, dates, location2id) を返す関数で、オフラインで試すときは差し替える
+    def __init__(self, model, meta, config, load_data=None, max_batch_size=64, max_latency=0.005, timeout=10.0):
+        self.meta = meta
+        self.config = config
+        self.load_data = load_data or (lambda: predict.latest_weekly(config))
+        self.data_key = (lambda: predict.data_key(config)) if load_data is None else (lambda: None)
+        self.location2column = {location: i for i, location in enumerate(meta["locations"])}
+        self.batcher = MicroBatcher(model, max_batch_size, max_latency)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.reload_lock = threading.Lock()
+        self.version = object()
+        self.weekly = self.dates = None
+        self.results = {}  # {(地域, 基準の週): Future}
+        self.stats = collections.Counter()
+
+    def refresh(self):
+        # 読み直しは self.lock の外で 1 スレッドだけが行い、他のリクエストはその間も古いデータで応答する (初回だけは待つ)
+        key = self.data_key()
+        if key == self.version:
+            return
+        if not self.reload_lock.acquire(blocking=self.weekly is None):
+            return
+        try:
+            if key == self.version:
+                return
+            weekly, dates, location2id = self.load_data()
+            # 書き出し時の地域の並びにそろえる
+            weekly = predict.align_locations(weekly, location2id, self.meta["locations"])  # [T, 地域]
+            dates = np.asarray(dates, dtype="datetime64[D]")
+            with self.lock:
+                self.weekly, self.dates, self.results, self.version = weekly, dates, {}, key
+                self.stats["reloads"] += 1
+        finally:
+            self.reload_lock.release()
+
+    def forecast(self, location, as_of=None):
+        # as_of (YYYY-MM-DD) 以前で最新の週を基準に t_seq 週先までを予測する。省略すると最新の週
+        self.refresh()
+        if location not in self.location2column:
+            raise KeyError(location)
+        column = self.location2column[location]
+        with self.lock:
+            weekly, dates, results = self.weekly, self.dates, self.results
+        end = len(dates) if as_of is None else int(np.searchsorted(dates, np.datetime64(as_of, "D"), side="right"))
+        X_seq = self.config["X_seq"]
+        if end < X_seq:
+            raise ValueError(f"need {X_seq} weeks of history before {as_of}")
+        key = (location, str(dates[end - 1]))
+        with self.lock:
+            self.stats["requests"] += 1
+            future = results.get(key)
+            if future is None:
+                window = weekly[end - X_seq : end, column]
+                enc_x = (window - self.meta["mean"][column]) / self.meta["scale"][column]
+                future = results[key] = self.batcher.submit(enc_x)
+            else:
+                self.stats["cache_hits"] += 1
+        try:
+            y = future.result(timeout=self.timeout)
+        except Exception as e:
+            with self.lock:
+                results.pop(key, None)
+            if isinstance(e, FutureTimeoutError):
+                raise
+            # モデルの例外は、入力の誤り (KeyError・ValueError) と区別できるよう RuntimeError にする
+            raise RuntimeError(f"model failed: {e!r}") from e
+        y = y * self.meta["scale"][column] + self.meta["mean"][column]
+        forecast_dates = dates[end - 1] + np.arange(1, len(y) + 1) * np.timedelta64(7, "D")
+        return {
+            "location": location,
+            "as_of": key[1],
+            "dates": [str(i) for i in forecast_dates],
+            "forecast": [float(i) for i in y],
+        }
+
+    def metrics(self):
+        return {
+            "queue_depth": self.batcher.queue.qsize(),
+            "batch_size_histogram": {str(k): v for k, v in sorted(self.batcher.histogram.items())},
+            "cached": len(self.results),
+            **self.stats,
+        }
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        # GET /forecast?location=Tokyo[&as_of=2021-10-03] と GET /metrics
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            try:
+                if url.path == "/forecast" and "location" in query:
+                    self.send_json(200, service.forecast(query["location"], query.get("as_of")))
+                elif url.path == "/metrics":
+                    self.send_json(200, service.metrics())
+                else:
+                    self.send_json(404, {"error": f"unknown path {self.path}"})
+            except KeyError as e:
+                self.send_json(404, {"error": f"unknown location {e.args[0]}"})
+            except ValueError as e:
+                self.send_json(400, {"error": str(e)})
+            except FutureTimeoutError:
+                self.send_json(503, {"error": f"forecast timed out after {service.timeout} s"})
+            except Exception as e:
+                self.send_json(500, {"error": str(e)})
+
+        def send_json(self, status, body):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def make_server(service, host="127.0.0.1", port=8000):
+    return ThreadingHTTPServer((host, port), make_handler(service))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=predict.OUTPUT)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch_size", type=int, default=64)
+    parser.add_argument("--max_latency", type=float, default=0.005, help="バッチを待つ最大の秒数")
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    model, meta, config = predict.load(args.model)
+    service = ForecastService(model, meta, config, max_batch_size=args.max_batch_size, max_latency=args.max_latency)
+    service.refresh()
+    server = make_server(service, args.host, args.port)
+    print(f"serving on http://{args.host}:{server.server_address[1]}")
+    server.serve_forever()
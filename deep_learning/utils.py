@@ -1,20 +1,30 @@
 import copy
+import io
+import json
+import os
+import queue
+import threading
 
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
 import torch
+import torch.distributed as dist
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
 
+import cache
+from predict import align_locations
+
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
 
 class Dataset(torch.utils.data.Dataset):
     def __init__(self, enc_X, dec_X, t, location, location_num):
-        self.enc_X = np.array(list(reversed(enc_X)))
-        self.dec_X = np.array(list(reversed(dec_X)))
-        self.t = np.array(list(reversed(t)))
-        self.location = np.array(list(reversed(location)))
+        self.enc_X = enc_X
+        self.dec_X = dec_X
+        self.t = t
+        self.location = location
         self.location_num = location_num
         self.size = self.t.size
 
@@ -30,18 +40,276 @@ class Dataset(torch.utils.data.Dataset):
         return len(self.enc_X)
 
 
+class TensorDataset(torch.utils.data.Dataset):
+    def __init__(self, enc_X, dec_X, t, location, location_num, device=None, pin_memory=False):
+        self.enc_X = torch.as_tensor(enc_X, dtype=torch.float32).contiguous()
+        self.dec_X = torch.as_tensor(dec_X, dtype=torch.float32).contiguous()
+        self.t = torch.as_tensor(t, dtype=torch.float32).contiguous()
+        self.location = torch.as_tensor(location, dtype=torch.int64).contiguous()
+        self.location_num = location_num
+        self.size = self.t.numel()
+        self.pin_memory = pin_memory and device is None and torch.cuda.is_available()
+        if self.pin_memory:
+            self.enc_X, self.dec_X, self.t, self.location = [i.pin_memory() for i in self.tensors]
+        elif device is not None:
+            self.enc_X, self.dec_X, self.t, self.location = [i.to(device) for i in self.tensors]
+
+    @property
+    def tensors(self):
+        return self.enc_X, self.dec_X, self.t, self.location
+
+    @property
+    def device(self):
+        return self.t.device
+
+    def __getitem__(self, idx):
+        return tuple(i[idx] for i in self.tensors)
+
+    def __len__(self):
+        return len(self.enc_X)
+
+
+class TensorDataLoader:
+    # サンプル単位の __getitem__ と collate を使わず、添字のスライスでバッチを切り出す
+    # world_size > 1 のときは DistributedSampler と同じく、各 rank が添字の rank::world_size 番目だけを受け持つ
+    def __init__(self, dataset, batch_size, shuffle=False, rank=0, world_size=1, seed=0):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def indices(self):
+        n = len(self.dataset)
+        if self.world_size == 1:
+            return torch.randperm(n, device=self.dataset.device) if self.shuffle else None
+        if self.shuffle:
+            # 全 rank で同じ順列を作り、バッチ数がそろうよう先頭を繰り返して world_size の倍数にする
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            idx = torch.randperm(n, generator=generator)
+            idx = torch.cat([idx, idx[: -n % self.world_size]]) if n % self.world_size else idx
+        else:
+            idx = torch.arange(n)
+        return idx[self.rank :: self.world_size].to(self.dataset.device)
+
+    def __iter__(self):
+        tensors = self.dataset.tensors
+        idx = self.indices()
+        if idx is not None:
+            tensors = [i[idx] for i in tensors]
+            if self.dataset.pin_memory:
+                tensors = [i.pin_memory() for i in tensors]
+        for start in range(0, len(tensors[0]), self.batch_size):
+            yield tuple(i[start : start + self.batch_size] for i in tensors)
+
+    def __len__(self):
+        n = len(self.dataset)
+        if self.world_size > 1:
+            n = -(-n // self.world_size) if self.shuffle else len(range(self.rank, n, self.world_size))
+        return (n + self.batch_size - 1) // self.batch_size
+
+
+def set_epoch(dataloader, epoch):
+    # 分散学習時のシャッフルを epoch ごとに変える (DistributedSampler と TensorDataLoader の両方)
+    sampler = getattr(dataloader, "sampler", None)
+    for i in [dataloader, sampler]:
+        if hasattr(i, "set_epoch"):
+            i.set_epoch(epoch)
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def init_distributed(rank, world_size, threads=None, master_addr="127.0.0.1", master_port=29500):
+    # CPU のみのノードで gloo バックエンドのプロセスグループを作り、コア数を rank 間で分け合う
+    os.environ.setdefault("MASTER_ADDR", master_addr)
+    os.environ.setdefault("MASTER_PORT", str(master_port))
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    threads = threads or max(1, (os.cpu_count() or 1) // world_size)
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+
+def _shadow_like(obj, pin_memory):
+    # state_dict と同じ構造で CPU 上のテンソルを確保する
+    if isinstance(obj, torch.Tensor):
+        return torch.empty(obj.shape, dtype=obj.dtype, device="cpu", pin_memory=pin_memory and obj.is_cuda)
+    if isinstance(obj, dict):
+        return {k: _shadow_like(v, pin_memory) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_shadow_like(i, pin_memory) for i in obj)
+    return copy.deepcopy(obj)
+
+
+def _copy_into(shadow, obj, non_blocking):
+    # テンソルは確保済みのコピーに copy_ で上書きし、それ以外の値は置き換えた構造を返す
+    if isinstance(obj, torch.Tensor):
+        if shadow.shape != obj.shape or shadow.dtype != obj.dtype:
+            return obj.detach().to("cpu", copy=True)
+        return shadow.copy_(obj.detach(), non_blocking=non_blocking and shadow.is_pinned())
+    if isinstance(obj, dict):
+        return {k: _copy_into(shadow[k] if k in shadow else _shadow_like(v, False), v, non_blocking) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_copy_into(i, j, non_blocking) for i, j in zip(shadow, obj))
+    return copy.deepcopy(obj)
+
+
+class CheckpointManager:
+    # モデル (と optimizer) の CPU 上のコピーを 1 つだけ確保して copy_ で上書きし、ディスクへの保存は別スレッドで行う
+    # directory を指定すると val の値が良い順に top_k 個のチェックポイントを残す
+    # resume でないときは前回の実行の checkpoints.json・history.jsonl を引き継がない
+    def __init__(self, directory=None, top_k=3, non_blocking=True, resume=False):
+        self.directory = directory
+        self.top_k = top_k
+        self.non_blocking = non_blocking
+        self.state = None
+        self.free = []  # 書き出しが終わって使い回せる、書き出し用のコピー
+        self.saved = []  # [(value, path)]
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.event = None
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            if not resume:
+                open(self.history_path, "w").close()
+            elif os.path.exists(self.index_path):
+                with open(self.index_path, encoding="utf-8") as f:
+                    self.saved = [tuple(i) for i in json.load(f) if os.path.exists(i[1])]
+            self.writer = threading.Thread(target=self._write_loop, daemon=True)
+            self.writer.start()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, "checkpoints.json")
+
+    @property
+    def history_path(self):
+        return os.path.join(self.directory, "history.jsonl")
+
+    @property
+    def best_state_dict(self):
+        self.synchronize()
+        return None if self.state is None else self.state["net"]
+
+    def snapshot(self, net, optimizer=None):
+        state = {"net": net.state_dict()}
+        # optimizer の状態は再開用に書き出すときだけ使うので、書き出し先が無ければモデルの重みだけを写す
+        if optimizer is not None and self.directory is not None:
+            state["optimizer"] = optimizer.state_dict()
+        with self.lock:
+            if self.state is None:
+                self.state = _shadow_like(state, self.non_blocking and torch.cuda.is_available())
+            self.state = _copy_into(self.state, state, self.non_blocking)
+            if self.non_blocking and torch.cuda.is_available():
+                self.event = torch.cuda.Event()
+                self.event.record()
+
+    def synchronize(self):
+        if self.event is not None:
+            self.event.synchronize()
+            self.event = None
+
+    def save(self, value, **meta):
+        # 直前の snapshot を書き出し用のコピーに写し、バックグラウンドでディスクに書き出す
+        # (self.state は次の snapshot で上書きされるので、書き出しが後になっても呼んだ時点の重みが残るようにする)
+        if self.directory is None:
+            return
+        with self.lock:
+            self.synchronize()
+            shadow = self.free.pop() if self.free else _shadow_like(self.state, False)
+            state = _copy_into(shadow, self.state, False)
+        self.queue.put((state, value, copy.deepcopy(meta)))
+
+    def log(self, epoch, **values):
+        # エポックごとの値を history.jsonl に 1 行ずつ追記する (再開時は history で読み戻す)
+        if self.directory is not None:
+            with open(self.history_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"epoch": epoch, **values}) + "\n")
+
+    def history(self, epoch):
+        # history.jsonl の epoch までの行を返し、続きを追記できるようファイルもそこまでに切り詰める
+        rows = []
+        if os.path.exists(self.history_path):
+            with open(self.history_path, encoding="utf-8") as f:
+                rows = [json.loads(i) for i in f if i.endswith("\n")]  # 書きかけの最後の行は捨てる
+        rows = [i for i in rows if i["epoch"] <= epoch]
+        with open(self.history_path, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(i) + "\n" for i in rows)
+        return rows
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            state, value, meta = item
+            try:
+                self._write(state, value, meta)
+            finally:
+                self.queue.task_done()
+
+    def _write(self, state, value, meta):
+        # メモリ上でシリアライズしたらコピーを返し、一時ファイルに書いて rename する
+        buffer = io.BytesIO()
+        torch.save({**state, **meta, "value": value}, buffer)
+        with self.lock:
+            self.free.append(state)
+        path = os.path.join(self.directory, f"epoch{meta.get('epoch', 0):06d}.pt")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(buffer.getbuffer())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self.saved = sorted([i for i in self.saved if i[1] != path] + [(value, path)])
+        for _, old_path in self.saved[self.top_k :]:
+            if os.path.exists(old_path):
+                os.remove(old_path)
+        self.saved = self.saved[: self.top_k]
+        with open(f"{self.index_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(self.saved, f)
+        os.replace(f"{self.index_path}.tmp", self.index_path)
+
+    def best(self):
+        # 再開用に最良のチェックポイントを読み込む
+        self.close()
+        if not self.saved:
+            return None
+        return torch.load(self.saved[0][1], map_location="cpu")
+
+    def close(self):
+        if self.directory is not None and self.writer.is_alive():
+            self.queue.join()
+
+    def __del__(self):
+        if self.directory is not None and self.writer.is_alive():
+            self.queue.put(None)
+
+
 class EarlyStopping:
-    def __init__(self, patience):
+    def __init__(self, patience, checkpoint=None):
         self.patience = patience
         self.counter = 0
         self.best_value = 1e10
         self.early_stop = False
-        self.best_state_dict = None
+        self.checkpoint = CheckpointManager() if checkpoint is None else checkpoint
 
-    def __call__(self, net, value):
+    @property
+    def best_state_dict(self):
+        return self.checkpoint.best_state_dict
+
+    def __call__(self, net, value, optimizer=None, **meta):
         if value <= self.best_value:
             self.best_value = value
-            self.best_state_dict = copy.deepcopy(net.state_dict())
+            self.checkpoint.snapshot(net, optimizer)
+            self.checkpoint.save(value, **meta)
             self.counter = 0
         else:
             self.counter += 1
@@ -51,38 +319,148 @@ class EarlyStopping:
             return False
 
 
-def get_dataloader(X_seq, t_seq, use_val, mode, batch_size):
-    if mode == "Japan":
-        df = pd.read_csv("data/raw/Japan.csv").drop("ALL", axis=1)
-    elif mode == "World":
-        df = pd.read_csv("data/raw/World.csv")
-        df_group = df.groupby("location")
+class EnsembleEarlyStopping:
+    # EnsembleNet のメンバーごとに EarlyStopping と同じ判定をし、改善したメンバーの重みだけを最良のコピーに書き込む
+    def __init__(self, patience, num_members):
+        self.patience = patience
+        self.counter = np.zeros(num_members, dtype=np.int64)
+        self.best_value = np.full(num_members, 1e10)
+        self.stopped = np.zeros(num_members, dtype=bool)
+        self.best_state_dict = None
+
+    @property
+    def active(self):
+        return ~self.stopped
 
-        def func(df):
-            location = df["location"].iat[0]
-            return pd.DataFrame({"Date": df["date"], location: df["new_cases"]})
+    def __call__(self, net, values):
+        # values: [K] メンバーごとの val の値。全メンバーが止まったら True を返す
+        improved = (np.asarray(values) <= self.best_value) & ~self.stopped
+        self.best_value = np.where(improved, values, self.best_value)
+        self.counter = np.where(improved, 0, self.counter + ~self.stopped)
+        self.stopped |= self.counter == self.patience
+        if self.best_state_dict is None:
+            self.best_state_dict = {k: v.detach().to("cpu", copy=True) for k, v in net.state_dict().items()}
+        elif improved.any():
+            idx = np.flatnonzero(improved)
+            with torch.no_grad():
+                for name, param in net.named_parameters():
+                    self.best_state_dict[name][idx] = param[torch.as_tensor(idx, device=param.device)].cpu()
+        return bool(self.stopped.all())
 
-        df_group.apply(func)
 
-        df = pd.DataFrame({"Date": []})
-        for i in df_group:
-            df = pd.merge(df, func(i[1]), on="Date", how="outer")
-        df = df.sort_values("Date").reset_index(drop=True)
+def window_starts(T, X_seq, t_seq, step=None):
+    step = t_seq if step is None else step
+    if step < 1:
+        raise ValueError(f"step must be >= 1, got {step}")
+    return np.arange(T - X_seq - t_seq, -1, -step)[::-1]
+
+
+def make_windows(data, X_seq, t_seq, step=None, is_test=False):
+    # data: [location_num, T]
+    # 末尾から step ずつずらした窓を切り出し、時系列順 (窓内の地域は逆順) に並べる
+    location_num, T = data.shape
+    starts = window_starts(T, X_seq, t_seq, step)  # [W]
+    if len(starts) == 0:
+        # X_seq + t_seq より短い split は窓を作れないので空の配列を返す
+        dec_len = 1 if is_test else t_seq
+        return (
+            np.empty((0, X_seq), dtype=data.dtype),
+            np.empty((0, dec_len), dtype=data.dtype),
+            np.empty((0, t_seq), dtype=data.dtype),
+            np.empty(0, dtype=int),
+        )
+    rows = starts[:, None]  # [W, 1]
+    cols = np.arange(location_num)[::-1][None, :]  # [1, location_num]
+    enc_view = sliding_window_view(data, X_seq, axis=1).transpose(1, 0, 2)  # [T - X_seq + 1, location_num, X_seq]
+    t_view = sliding_window_view(data, t_seq, axis=1).transpose(1, 0, 2)  # [T - t_seq + 1, location_num, t_seq]
+    enc_X = enc_view[rows, cols].reshape(-1, X_seq)  # [W * location_num, X_seq]
+    if is_test:
+        dec_X = data.T[rows + X_seq - 1, cols].reshape(-1, 1)  # [W * location_num, 1]
+    else:
+        dec_X = t_view[rows + X_seq - 1, cols].reshape(-1, t_seq)  # [W * location_num, t_seq]
+    t = t_view[rows + X_seq, cols].reshape(-1, t_seq)  # [W * location_num, t_seq]
+    location = np.tile(cols[0], len(starts))  # [W * location_num]
+    return enc_X, dec_X, t, location
+
+
+SOURCES = {"Japan": "data/raw/Japan.csv", "World": "data/raw/World.csv", "Tokyo": "data/raw/Japan.csv"}
+SPLITS = ["train", "val", "test"]
+WINDOW_ARRAYS = ["enc_X", "dec_X", "t", "location"]
+
+
+def load_world(path=SOURCES["World"], chunksize=1000000):
+    # 1 回目は date・location の列だけをチャンクごとに読んで 日付×地域 の行列の形を決め、
+    # 2 回目に値をチャンクごとに確保済みの行列へ直接書き込む (全行ぶんの中間配列は作らない)
+    def read(usecols):
+        dtype = {"date": "category", "location": "category", "new_cases": "float32"}
+        return pd.read_csv(path, usecols=usecols, dtype={i: dtype[i] for i in usecols}, chunksize=chunksize)
+
+    def categories(chunk, column):
+        return chunk[column].cat.remove_unused_categories().cat.categories
+
+    dates, locations = set(), set()
+    for chunk in read(["date", "location"]):
+        chunk = chunk.dropna()
+        dates.update(pd.to_datetime(categories(chunk, "date")).values.astype("datetime64[D]"))
+        locations.update(categories(chunk, "location"))
+    dates = np.array(sorted(dates), dtype="datetime64[D]")
+    locations = sorted(locations)
+    location2column = {j: i for i, j in enumerate(locations)}
+
+    matrix = np.full((len(dates), len(locations)), np.nan, np.float32)
+    for chunk in read(["date", "location", "new_cases"]):
+        chunk = chunk.dropna(subset=["date", "location"])
+        date, location = chunk["date"].cat, chunk["location"].cat
+        rows = np.searchsorted(dates, pd.to_datetime(date.categories).values.astype("datetime64[D]"))
+        columns = np.array([location2column.get(i, -1) for i in location.categories], np.int64)
+        matrix[rows[date.codes.values], columns[location.codes.values]] = chunk["new_cases"].values
+    df = pd.DataFrame(matrix, columns=locations, copy=False)
+    df.insert(0, "Date", dates)
+    return df
+
+
+def load_frame(mode):
+    # Date 列と地域ごとの日次感染者数の列を持つ DataFrame を返す
+    if mode == "Japan":
+        df = pd.read_csv(SOURCES[mode]).drop("ALL", axis=1)
+    elif mode == "World":
+        df = load_world(SOURCES[mode])
     elif mode == "Tokyo":
-        df = pd.read_csv("data/raw/Japan.csv")
+        df = pd.read_csv(SOURCES[mode])
         df = df[["Date", "Tokyo"]]
+    return df
+
+
+def load_weekly(mode):
+    df = load_frame(mode)
     df["Date"] = pd.to_datetime(df["Date"])
     df = df.resample("W", on="Date").mean()
     # df = df.drop("Date", axis=1)
-    data = np.nan_to_num(df.values, 0.0)
+    data = np.nan_to_num(df.values.astype(np.float64), 0.0)
     location2id = {i: j for j, i in enumerate(df.columns)}
+    return data, df.index.values.astype("datetime64[D]"), location2id
+
+
+def load_weekly_aligned(mode, location2id):
+    # 前回と同じ地域の並びにそろえる
+    data, dates, new_location2id = load_weekly(mode)
+    return align_locations(data, new_location2id, location2id), dates
+
 
+def split_weeks(data, use_val):
     if use_val:
         train_data, val_data = train_test_split(data, train_size=0.6, shuffle=False)
         val_data, test_data = train_test_split(val_data, train_size=0.5, shuffle=False)
     else:
         train_data, test_data = train_test_split(data, train_size=0.8, shuffle=False)
         val_data = test_data.copy()  # 下のコードの整合性のため
+    return train_data, val_data, test_data
+
+
+def preprocess(X_seq, t_seq, use_val, mode, step=None):
+    data, dates, location2id = load_weekly(mode)
+
+    train_data, val_data, test_data = split_weeks(data, use_val)
     scaler = StandardScaler()
     scaler.fit(train_data)
     train_data = scaler.transform(train_data)
@@ -93,53 +471,259 @@ def get_dataloader(X_seq, t_seq, use_val, mode, batch_size):
     val_data = val_data.T
     test_data = test_data.T
 
-    train_enc_X = []
-    train_dec_X = []
-    train_t = []
-    train_location = []
-    val_enc_X = []
-    val_dec_X = []
-    val_t = []
-    val_location = []
-    test_enc_X = []
-    test_dec_X = []
-    test_t = []
-    test_location = []
-    for i, (data, enc_X, dec_X, t, location) in enumerate(
+    arrays = {"weekly": data, "dates": dates}
+    for split, split_data in zip(SPLITS, [train_data, val_data, test_data]):
+        windows = make_windows(split_data, X_seq, t_seq, step, is_test=split == "test")
+        arrays.update({f"{split}_{name}": array for name, array in zip(WINDOW_ARRAYS, windows)})
+    for name in ["mean_", "var_", "scale_", "n_samples_seen_"]:
+        arrays[f"scaler_{name}"] = np.asarray(getattr(scaler, name))
+    return arrays, location2id
+
+
+def load_scaler(arrays):
+    scaler = StandardScaler()
+    for name in ["mean_", "var_", "scale_"]:
+        setattr(scaler, name, np.asarray(arrays[f"scaler_{name}"]))
+    scaler.n_samples_seen_ = np.asarray(arrays["scaler_n_samples_seen_"]).copy()
+    scaler.n_features_in_ = len(scaler.mean_)
+    return scaler
+
+
+def load_preprocessed(X_seq, t_seq, use_val, mode, step=None, use_cache=True):
+    # 前処理結果を data/cache に .npy として保存し、2 回目以降は pandas を通さず memmap で開く
+    if not use_cache:
+        return preprocess(X_seq, t_seq, use_val, mode, step)
+    key = cache.cache_key(mode, [SOURCES[mode]], X_seq=X_seq, t_seq=t_seq, use_val=use_val, step=step)
+    cached = cache.load(key)
+    if cached is None:
+        arrays, location2id = preprocess(X_seq, t_seq, use_val, mode, step)
+        cache.save(key, arrays, {"location2id": location2id})
+        cached = cache.load(key)
+    arrays, meta = cached
+    return arrays, meta["location2id"]
+
+
+def build_dataloader(
+    windows, location_num, batch_size, shuffle=False, loader="torch", device=None, pin_memory=False, rank=0, world_size=1
+):
+    if loader == "tensor":
+        dataset = TensorDataset(*windows, location_num, device=device, pin_memory=pin_memory)
+        return TensorDataLoader(dataset, batch_size=batch_size, shuffle=shuffle, rank=rank, world_size=world_size)
+    dataset = Dataset(*windows, location_num)
+    if world_size == 1:
+        return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle)
+    if shuffle:
+        sampler = torch.utils.data.DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=True)
+    else:
+        # 評価では窓を重複させず、各 rank の集計を足し合わせると全体に一致するようにする
+        sampler = range(rank, len(dataset), world_size)
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, sampler=sampler)
+
+
+def get_dataloader(
+    X_seq,
+    t_seq,
+    use_val,
+    mode,
+    batch_size,
+    step=None,
+    loader="torch",
+    device=None,
+    pin_memory=False,
+    use_cache=True,
+    rank=0,
+    world_size=1,
+):
+    arrays, location2id = load_preprocessed(X_seq, t_seq, use_val, mode, step, use_cache)
+    scaler = load_scaler(arrays)
+    location_num = len(location2id)
+    train_dataloader, val_dataloader, test_dataloader = [
+        build_dataloader(
+            [arrays[f"{split}_{name}"] for name in WINDOW_ARRAYS],
+            location_num,
+            batch_size,
+            shuffle=split == "train",
+            loader=loader,
+            device=device,
+            pin_memory=pin_memory,
+            rank=rank,
+            world_size=world_size,
+        )
+        for split in SPLITS
+    ]
+    return train_dataloader, val_dataloader, test_dataloader, scaler, location2id
+
+
+def get_test_dataloader(X_seq, t_seq, mode, batch_size, scaler, location2id, step=None, use_val=True, loader="torch"):
+    # 保存したモデルの scaler と地域の並びのまま test の窓を作る (get_dataloader は今のデータで scaler を fit し直す)
+    data, _ = load_weekly_aligned(mode, location2id)
+    _, _, test_data = split_weeks(data, use_val)
+    windows = make_windows(scaler.transform(test_data).T, X_seq, t_seq, step, is_test=True)
+    return build_dataloader(windows, len(location2id), batch_size, loader=loader)
+
+
+def get_incremental_dataloader(
+    X_seq,
+    t_seq,
+    mode,
+    batch_size,
+    scaler,
+    location2id,
+    prev_weeks,
+    step=None,
+    replay=4.0,
+    val_windows=1,
+    seed=0,
+    loader="torch",
+    device=None,
+    pin_memory=False,
+):
+    # 前回の学習時の scaler を固定したまま、追加された週を含む窓と、それ以前の窓から抽出したリプレイで学習データを作る
+    # 最後の週は途中までの平均なので、前回の最終週を含む窓も新しい窓として扱う
+    # 新しい窓のうち最新の val_windows 個は学習に使わず val にする (新しい窓が val_windows 個以下なら直前の古い窓を使う)
+    data, _ = load_weekly_aligned(mode, location2id)
+    scaled = scaler.transform(data).T  # [location_num, T]
+
+    location_num = len(location2id)
+    starts = window_starts(len(data), X_seq, t_seq, step)
+    is_new = starts + X_seq + t_seq >= prev_weeks
+    if not is_new.any():
+        raise ValueError("no new weeks since the previous training")
+    new_idx = np.flatnonzero(is_new)
+    old_idx = np.flatnonzero(~is_new)
+    if len(new_idx) > val_windows:
+        new_idx, val_idx = new_idx[:-val_windows], new_idx[-val_windows:]
+    else:
+        # 1 週だけの追加 (step = t_seq なら新しい窓は 1 個) などで新しい窓が足りないときは、新しい窓はすべて学習に使い、
+        # その直前の古い窓を val にする (リプレイからは除く)
+        if len(old_idx) < val_windows:
+            raise ValueError(f"need at least {val_windows} old windows for validation, got {len(old_idx)}")
+        old_idx, val_idx = old_idx[: len(old_idx) - val_windows], old_idx[len(old_idx) - val_windows :]
+    rng = np.random.default_rng(seed)
+    replay_idx = rng.choice(old_idx, size=min(len(old_idx), int(replay * len(new_idx))), replace=False)
+    windows = [i.reshape(len(starts), location_num, -1) for i in make_windows(scaled, X_seq, t_seq, step)]
+
+    def select(idx):
+        # 窓単位で取り出し、窓ごとに全地域が並ぶ順序を保つ
+        enc_X, dec_X, t, location = [i[idx].reshape(len(idx) * location_num, -1) for i in windows]
+        return enc_X, dec_X, t, location.reshape(-1)
+
+    train_dataloader = build_dataloader(
+        select(np.sort(np.concatenate([new_idx, replay_idx]))),
+        location_num,
+        batch_size,
+        shuffle=True,
+        loader=loader,
+        device=device,
+        pin_memory=pin_memory,
+    )
+    val_dataloader = build_dataloader(
+        select(val_idx), location_num, batch_size, loader=loader, device=device, pin_memory=pin_memory
+    )
+    return train_dataloader, val_dataloader, len(data)
+
+
+class InverseScaler:
+    # StandardScaler の mean_・scale_ を学習デバイスに置き、地域 id で gather して元のスケールに戻す
+    def __init__(self, scaler, device=DEVICE, dtype=torch.float64):
+        self.mean = torch.as_tensor(scaler.mean_, dtype=dtype, device=device)  # [location_num]
+        self.scale = torch.as_tensor(scaler.scale_, dtype=dtype, device=device)  # [location_num]
+
+    def __call__(self, x, location):
+        location = location.to(self.mean.device, non_blocking=True)  # [N]
+        x = x.detach().to(self.mean.device, self.mean.dtype)  # [N, T]
+        return x * self.scale[location].unsqueeze(-1) + self.mean[location].unsqueeze(-1)  # [N, T]
+
+
+def _merge_moments(a, b):
+    # Metrics の状態 [8, location_num] を 2 つ、地域ごとに 1 つにまとめる
+    n_a, se_a, ae_a, mean_y_a, mean_t_a, m2_y_a, m2_t_a, c_yt_a = a
+    n_b, se_b, ae_b, mean_y_b, mean_t_b, m2_y_b, m2_t_b, c_yt_b = b
+    n = n_a + n_b
+    w = n_a * n_b / n.clamp(min=1)
+    delta_y = mean_y_b - mean_y_a
+    delta_t = mean_t_b - mean_t_a
+    return torch.stack(
         [
-            [train_data, train_enc_X, train_dec_X, train_t, train_location],
-            [val_data, val_enc_X, val_dec_X, val_t, val_location],
-            [test_data, test_enc_X, test_dec_X, test_t, test_location],
+            n,
+            se_a + se_b,
+            ae_a + ae_b,
+            mean_y_a + delta_y * n_b / n.clamp(min=1),
+            mean_t_a + delta_t * n_b / n.clamp(min=1),
+            m2_y_a + m2_y_b + delta_y**2 * w,
+            m2_t_a + m2_t_b + delta_t**2 * w,
+            c_yt_a + c_yt_b + delta_y * delta_t * w,
         ]
-    ):
-        now_idx = data.shape[1]
-        while True:
-            if now_idx - X_seq - t_seq < 0:
-                break
-            enc_X += data[:, now_idx - X_seq - t_seq : now_idx - t_seq].tolist()
-            if i == 2:
-                dec_X += data[:, now_idx - t_seq - 1 : now_idx - t_seq].tolist()
-            else:
-                dec_X += data[:, now_idx - t_seq - 1 : now_idx - 1].tolist()
-            t += data[:, now_idx - t_seq : now_idx].tolist()
-            now_idx -= t_seq
-            location += list(range(data.shape[0]))
-
-    location_num = len(np.unique(location))
-    train_dataset = Dataset(train_enc_X, train_dec_X, train_t, train_location, location_num)
-    val_dataset = Dataset(val_enc_X, val_dec_X, val_t, val_location, location_num)
-    test_dataset = Dataset(test_enc_X, test_dec_X, test_t, test_location, location_num)
-    train_dataloader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-    val_dataloader = torch.utils.data.DataLoader(val_dataset, batch_size=batch_size)
-    test_dataloader = torch.utils.data.DataLoader(test_dataset, batch_size=batch_size)
-    return train_dataloader, val_dataloader, test_dataloader, scaler, location2id
+    )
+
+
+class Metrics:
+    # 二乗誤差・絶対誤差の和と相関係数のモーメントを地域ごとにデバイス上で集計し、compute() で 1 回だけ同期する
+    # 相関係数はバッチごとのモーメントを Chan らの方法 (Welford の並列版) で合成する
+    def __init__(self, location_num, device=DEVICE, dtype=torch.float64):
+        self.location_num = location_num
+        self.dtype = dtype
+        # count, se, ae, mean_y, mean_t, m2_y, m2_t, c_yt
+        self.state = torch.zeros(8, location_num, dtype=dtype, device=device)
+
+    def _sum(self, location, x):
+        return torch.zeros(self.location_num, dtype=self.dtype, device=x.device).index_add_(0, location, x)
+
+    def update(self, y, t, location):
+        # y, t: [N, T], location: [N]
+        device = self.state.device
+        y = y.detach().to(device, self.dtype)
+        t = t.detach().to(device, self.dtype)
+        location = location.to(device, non_blocking=True).repeat_interleave(y.shape[-1])  # [N*T]
+        y = y.reshape(-1)  # [N*T]
+        t = t.reshape(-1)  # [N*T]
+        n_b = self._sum(location, torch.ones_like(y))
+        mean_y_b = self._sum(location, y) / n_b.clamp(min=1)
+        mean_t_b = self._sum(location, t) / n_b.clamp(min=1)
+        dy = y - mean_y_b[location]
+        dt = t - mean_t_b[location]
+        batch = torch.stack(
+            [
+                n_b,
+                self._sum(location, (y - t) ** 2),
+                self._sum(location, (y - t).abs()),
+                mean_y_b,
+                mean_t_b,
+                self._sum(location, dy * dy),
+                self._sum(location, dt * dt),
+                self._sum(location, dy * dt),
+            ]
+        )
+        self.state = _merge_moments(self.state, batch)
 
+    def all_reduce(self):
+        # 各 rank の状態 (件数・平均・偏差平方和) を all_gather し、update と同じく Chan らの方法で rank 順に合成する
+        # 和に直して all_reduce すると大きな値の引き算で桁落ちするため。全 rank が同じ値を得るので早期終了の判定もそろう
+        state = self.state.cpu()
+        gathered = [torch.empty_like(state) for _ in range(dist.get_world_size())]
+        dist.all_gather(gathered, state)
+        merged = gathered[0]
+        for other in gathered[1:]:
+            merged = _merge_moments(merged, other)
+        self.state = merged.to(self.state.device)
 
-def inverse_scaler(x, location, location_num, scaler):
-    x = x.detach().cpu().numpy()  # [N, T]
-    location = location.numpy().repeat(x.shape[-1])  # [N*T]
-    x = x.reshape(-1)  # [N*T]
-    placeholder = np.zeros([len(x), location_num])  # [N*T, location_num]
-    placeholder[range(len(placeholder)), location] = x
-    x_inverse = scaler.inverse_transform(placeholder)[range(len(placeholder)), location]  # [N*T]
-    return x_inverse
+    def compute(self):
+        n, se, ae, mean_y, mean_t, m2_y, m2_t, c_yt = self.state.cpu().numpy()
+        # 地域ごとのモーメントを全体のモーメントに合成する
+        total = n.sum()
+        total_mean_y = (n * mean_y).sum() / total
+        total_mean_t = (n * mean_t).sum() / total
+        total_m2_y = (m2_y + n * (mean_y - total_mean_y) ** 2).sum()
+        total_m2_t = (m2_t + n * (mean_t - total_mean_t) ** 2).sum()
+        total_c_yt = (c_yt + n * (mean_y - total_mean_y) * (mean_t - total_mean_t)).sum()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return {
+                "rmse": (se.sum() / total) ** 0.5,
+                "mae": ae.sum() / total,
+                "corrcoef": total_c_yt / (total_m2_y * total_m2_t) ** 0.5,
+                "count": total,
+                "rmse_per_location": (se / n) ** 0.5,
+                "mae_per_location": ae / n,
+                "corrcoef_per_location": c_yt / (m2_y * m2_t) ** 0.5,
+                "count_per_location": n,
+            }
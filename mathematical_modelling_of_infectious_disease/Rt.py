@@ -1,23 +1,105 @@
 #%%
 # https://www.niid.go.jp/niid/ja/diseases/ka/corona-virus/2019-ncov/2502-idsc/iasr-in/10465-496d04.html
+# Cori et al. (2013) https://doi.org/10.1093/aje/kwt133
 
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
+from scipy import stats
 
-df = pd.read_csv("data/use/count.csv", index_col=0, parse_dates=True)
+import prefecture
 
-df = df.rolling(7).mean()
-for i in range(3, 8):
-    df[f"Rt_{i}"] = df["count"] / df["count"].shift(i)
-df = df.dropna(how="any")
+"""
+実効再生産数 Rt を 日付×都道府県 の新規感染者数の行列 [T, P] からまとめて求める
 
-df = df[~(df == np.inf).sum(axis=1).astype(bool)]
+ratio: 7 日平均の報告数と、その lag 日前の値の比 (lag は 3〜7 日)
+cori: 直近 window 日の新規感染者数 I_t と感染力 Lambda_t = sum_s w_s * I_{t-s} (w は発症間隔の分布) から、
+      Rt の事後分布 Gamma(a + sum I_t, 1 / b + sum Lambda_t) を求める (事前分布は Gamma(a, scale=b))
+窓の和は累積和の差で求めるので、計算量は window によらず O(T * P)
+"""
 
-for i in range(3, 8):
-    # plt.plot(df[f"Rt_{i}"].iloc[-260:-170], alpha=0.5, label=f"Rt_{i}")
-    plt.plot(df[f"Rt_{i}"], alpha=0.5, label=f"Rt_{i}")
-plt.legend()
-plt.xticks(rotation=45)
-plt.ylim(0)
-plt.axhline(1.00, c="black", alpha=0.5)
+
+def window_sum(x, window):
+    # 後ろ向きの window 日の和 [T, P]。window 日そろわない先頭と、窓に NaN を含む日は NaN
+    valid = ~np.isnan(x)
+    cumsum = np.concatenate([np.zeros((1,) + x.shape[1:]), np.cumsum(np.where(valid, x, 0.0), axis=0)])
+    missing = np.concatenate([np.zeros((1,) + x.shape[1:]), np.cumsum(~valid, axis=0)])
+    out = np.full(x.shape, np.nan)
+    out[window - 1 :] = cumsum[window:] - cumsum[:-window]
+    out[window - 1 :][(missing[window:] - missing[:-window]) > 0] = np.nan
+    return out
+
+
+def rolling_mean(x, window=7):
+    # pandas の rolling(window).mean() と同じ
+    return window_sum(x, window) / window
+
+
+def ratio(counts, lags=range(3, 8), window=7):
+    # 戻り値: [len(lags), T, P]。分母が 0 の日 (inf・0/0) は NaN
+    smoothed = rolling_mean(np.asarray(counts, dtype=np.float64), window)
+    out = np.full((len(lags),) + smoothed.shape, np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for k, lag in enumerate(lags):
+            out[k, lag:] = smoothed[lag:] / smoothed[:-lag]
+    out[~np.isfinite(out)] = np.nan
+    return out
+
+
+def serial_interval(mean=4.8, sd=2.3, max_days=20):
+    # 発症間隔の Gamma 分布を 1〜max_days 日に離散化した確率 w [max_days] (和は 1)
+    shape, scale = (mean / sd) ** 2, sd**2 / mean
+    cdf = stats.gamma.cdf(np.arange(0.5, max_days + 1.5), shape, scale=scale)
+    w = np.diff(cdf)
+    return w / w.sum()
+
+
+def infectiousness(counts, w):
+    # Lambda_t = sum_{s=1}^{len(w)} w_s * I_{t-s}  [T, P]
+    counts = np.asarray(counts, dtype=np.float64)
+    out = np.zeros_like(counts)
+    for s in range(1, min(len(w), len(counts) - 1) + 1):
+        out[s:] += w[s - 1] * counts[:-s]
+    return out
+
+
+def cori(counts, window=7, si_mean=4.8, si_sd=2.3, a=1.0, b=5.0, quantiles=(0.025, 0.5, 0.975)):
+    # 戻り値: (事後平均 [T, P], 事後分布の分位点 [len(quantiles), T, P])
+    # 欠けている日・負の値 (報告の訂正) は 0 とみなす。窓がそろわない日と、窓の感染力の和が 0 の日は NaN
+    counts = np.clip(np.nan_to_num(np.asarray(counts, dtype=np.float64)), 0, None)
+    Lambda = infectiousness(counts, serial_interval(si_mean, si_sd))
+    shape = a + window_sum(counts, window)
+    rate = 1 / b + window_sum(Lambda, window)
+    undefined = np.isnan(shape) | ~(rate > 1 / b)
+    shape, rate = np.where(undefined, 1.0, shape), np.where(undefined, 1.0, rate)
+    mean = np.where(undefined, np.nan, shape / rate)
+    q = stats.gamma.ppf(np.asarray(quantiles)[:, None, None], shape, scale=1 / rate)
+    q[:, undefined] = np.nan
+    return mean, q
+
+
+if __name__ == "__main__":
+    #%%
+    import matplotlib.pyplot as plt
+
+    counts, dates, prefectures = prefecture.load_count()
+    column = prefectures.index("ALL")
+
+    Rt = ratio(counts)
+    for k, lag in enumerate(range(3, 8)):
+        plt.plot(dates, Rt[k, :, column], alpha=0.5, label=f"Rt_{lag}")
+    plt.legend()
+    plt.xticks(rotation=45)
+    plt.ylim(0)
+    plt.axhline(1.00, c="black", alpha=0.5)
+    plt.show()
+
+    #%%
+    mean, (lower, median, upper) = cori(counts)
+    for name in ["ALL", "Tokyo", "Osaka", "Okinawa"]:
+        column = prefectures.index(name)
+        plt.plot(dates, mean[:, column], label=name)
+        plt.fill_between(dates, lower[:, column], upper[:, column], alpha=0.2)
+    plt.legend()
+    plt.xticks(rotation=45)
+    plt.ylim(0, 4)
+    plt.axhline(1.00, c="black", alpha=0.5)
+    plt.show()
@@ -0,0 +1,199 @@
+"""
+都道府県ごとに SEIR モデルのパラメータ (beta, epsilon, gamma, 検出率 delta) を data/raw/count.csv の新規感染者数に合わせる
+
+モデルは compartment.py の discrete (seir.py の差分方程式) を人口に対する割合 (s, e, i) で書いたもので、
+報告数のモデル値は 1 日あたりに I へ移る人数に検出率を掛けた N * delta * epsilon * e(t)
+損失は log(1 + 報告数の 7 日平均) の二乗誤差の平均で、勾配は前進感度方程式 (状態のパラメータに対する微分を状態と一緒に時間発展させる) で求める
+
+県外からの流入として毎日 imported 人が E に入る (流入がないと感染者の少ない県で流行が途絶え、その後を合わせられない)
+緊急事態宣言の開始・終了で期間を区切る場合、beta と delta は期間ごと、epsilon・gamma・imported は都道府県で共通とし、
+状態は期間をまたいでつなげる。期間を 1 つずつ増やしながら推定し、前の推定値を次の初期値にする
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+
+import prefecture
+
+# beta は人口を掛けた値 (beta * N) で推定し、結果は sir.py・seir.py と同じく人口で割った値で返す
+# beta * N <= 1 なら差分方程式の s, e, i が [0, 1] に収まる (s' = s * (1 - beta * N * i) >= 0)
+# epsilon・gamma は潜伏期間 2〜14 日・感染期間 3〜20 日に相当する範囲に制限する (制限しないと感受性人口を使い切る解に落ちやすい)
+SHARED = ["epsilon", "gamma", "imported"]
+LOCAL = ["beta", "delta"]
+BOUNDS = {"beta": (0.01, 1.0), "epsilon": (0.07, 0.5), "gamma": (0.05, 0.33), "delta": (0.01, 1.0), "imported": (1e-3, 1e2)}
+INITIAL = {"beta": 0.26, "epsilon": 0.2, "gamma": 0.1, "delta": 0.25, "imported": 1.0}
+# 新しい期間の beta を直前の期間の何倍から始めるか (一番よく合ったものを使う)
+BETA_STARTS = [0.25, 0.5, 1.0, 2.0]
+# epsilon・gamma を INITIAL (seir.py の値) に引き寄せる弱い事前分布の重み (log の差の二乗に掛ける)
+PRIOR = 0.01
+OUTPUT = "data/use/seir_fit.csv"
+
+
+def smooth(x, window=7):
+    # 曜日による揺れを消すため、後ろ向きの window 日平均をとる (先頭は使える日だけで平均する)
+    x = np.nan_to_num(x, nan=0.0)
+    cumsum = np.concatenate([[0.0], np.cumsum(x)])
+    idx = np.arange(1, len(x) + 1)
+    return (cumsum[idx] - cumsum[np.maximum(idx - window, 0)]) / np.minimum(idx, window)
+
+
+def unpack(theta, K):
+    # theta: [epsilon, gamma, imported, beta_1..beta_K, delta_1..delta_K]
+    return theta[0], theta[1], theta[2], theta[3 : 3 + K], theta[3 + K : 3 + 2 * K]
+
+
+def simulate(theta, window, N):
+    # window: [T] 各日の期間の番号 (0..K-1)
+    # 戻り値: 報告数のモデル値 m [T] と、その theta に対する感度 dm/dtheta [T, len(theta)]
+    K = (len(theta) - 3) // 2
+    eps, g, imported, b, delta = unpack(theta, K)
+    s, e, i = 1.0, 0.0, 0.0
+    dy = np.zeros((3, len(theta)))
+    m = np.empty(len(window))
+    dm = np.empty((len(window), len(theta)))
+    J = np.eye(3)
+    Jp = np.zeros((3, len(theta)))
+    for t, k in enumerate(window):
+        m[t] = N * delta[k] * eps * e
+        dm[t] = N * delta[k] * eps * dy[1]
+        dm[t, 0] += N * delta[k] * e
+        dm[t, 3 + K + k] += N * eps * e
+        # 1 日進める写像の状態・パラメータに対するヤコビアン
+        J[0, 0], J[0, 2] = 1 - b[k] * i, -b[k] * s
+        J[1, 0], J[1, 1], J[1, 2] = b[k] * i, 1 - eps, b[k] * s
+        J[2, 1], J[2, 2] = eps, 1 - g
+        Jp[:, 3 : 3 + K] = 0.0
+        Jp[0, 3 + k], Jp[1, 3 + k] = -s * i, s * i
+        Jp[1, 0], Jp[2, 0] = -e, e
+        Jp[2, 1] = -i
+        Jp[1, 2] = 1 / N
+        dy = J @ dy + Jp
+        infection = b[k] * s * i
+        s, e, i = s - infection, e + infection - eps * e + imported / N, i + eps * e - g * i
+    return m, dm
+
+
+def final_state(theta, window, N):
+    # simulate と同じ差分方程式を感度なしで進め、最後の日の翌日の状態 (s, e, i) を返す
+    K = (len(theta) - 3) // 2
+    eps, g, imported, b, _ = unpack(theta, K)
+    s, e, i = 1.0, 0.0, 0.0
+    for k in window:
+        infection = b[k] * s * i
+        s, e, i = s - infection, e + infection - eps * e + imported / N, i + eps * e - g * i
+    return s, e, i
+
+
+def fitted_state(rows, N):
+    # fit_prefecture の出力 (1 都道府県ぶんの行) から theta と期間を組み立て直し、最後の期間の翌日の状態を返す
+    days = (pd.to_datetime(rows["end"]) - pd.to_datetime(rows["start"])).dt.days.values + 1
+    window = np.concatenate([np.full(n, k) for k, n in enumerate(days)])
+    shared = rows[SHARED].iloc[0].values
+    theta = np.concatenate([shared, rows["beta"].values * N, rows["delta"].values]).astype(np.float64)
+    return final_state(theta, window, N)
+
+
+def loss_and_grad(x, counts, window, N):
+    # x は log(theta)
+    theta = np.exp(x)
+    m, dm = simulate(theta, window, N)
+    residual = np.log1p(m) - np.log1p(counts)
+    loss = np.mean(residual**2)
+    grad = (2 * residual / (1 + m)) @ dm / len(counts) * theta  # dL/dlog(theta)
+    prior = x[:2] - np.log([INITIAL["epsilon"], INITIAL["gamma"]])
+    grad[:2] += 2 * PRIOR * prior
+    return loss + PRIOR * np.sum(prior**2), grad
+
+
+def _minimize(x, free, bounds, counts, window, N):
+    # x のうち free の添字だけを動かして最小化する
+    def fun(z):
+        x[free] = z
+        loss, grad = loss_and_grad(x, counts, window, N)
+        return loss, grad[free]
+
+    result = minimize(fun, x[free], jac=True, method="L-BFGS-B", bounds=[bounds[i] for i in free])
+    x[free] = result.x
+    return x, result
+
+
+def fit_prefecture(name, counts, dates, windows, N):
+    # 最初に感染者が報告された日より前は推定せず、その日から流入が始まるとする
+    counts = smooth(counts)
+    first = int(np.argmax(counts > 0))
+    windows = [(max(start, first), end) for start, end in windows if end > first]
+    window = np.concatenate([np.full(end - start, k) for k, (start, end) in enumerate(windows)])
+    counts = counts[first:]
+
+    # 期間を 1 つずつ増やす。新しい期間の beta・delta を直前の期間の値 (beta は BETA_STARTS 倍) から始めて、まずそれだけを合わせ、
+    # その後すべてのパラメータをまとめて合わせ直す
+    # (beta を大きくしすぎると感受性人口を使い切り、勾配が 0 になる平らな所で止まるので、始める値を変えて試す)
+    shared = np.log([INITIAL[i] for i in SHARED])
+    local = np.log([[INITIAL[i] for i in LOCAL]])
+    for K in range(1, len(windows) + 1):
+        if K > 1:
+            local = np.concatenate([local, local[-1:]])
+        x = np.concatenate([shared, local[:, 0], local[:, 1]])
+        bounds = [BOUNDS[i] for i in SHARED] + [BOUNDS["beta"]] * K + [BOUNDS["delta"]] * K
+        bounds = [tuple(np.log(i)) for i in bounds]
+        T = windows[K - 1][1] - first
+        if K > 1:
+            candidates = []
+            for scale in BETA_STARTS:
+                x0 = x.copy()
+                x0[2 + K] = np.clip(x0[2 + K] + np.log(scale), *bounds[2 + K])
+                candidates.append(_minimize(x0, [2 + K, 2 + 2 * K], bounds, counts[:T], window[:T], N))
+            x, _ = min(candidates, key=lambda i: i[1].fun)
+        x, _ = _minimize(x, list(range(len(x))), bounds, counts[:T], window[:T], N)
+        shared, local = x[:3], np.stack([x[3 : 3 + K], x[3 + K :]], axis=1)
+
+    theta = np.exp(x)
+    eps, g, imported, b, delta = unpack(theta, len(windows))
+    m, _ = simulate(theta, window, N)
+    residual = (np.log1p(m) - np.log1p(counts)) ** 2
+    return [
+        {
+            "prefecture": name,
+            "start": str(dates[start]),
+            "end": str(dates[end - 1]),
+            "beta": b[k] / N,
+            "epsilon": eps,
+            "gamma": g,
+            "delta": delta[k],
+            "R0": b[k] / g,
+            "imported": imported,
+            "loss": residual[window == k].mean(),
+        }
+        for k, (start, end) in enumerate(windows)
+    ]
+
+
+def _fit_prefecture(args):
+    return fit_prefecture(*args)
+
+
+def fit_all(prefectures=None, piecewise=True, max_workers=None, count_path=prefecture.COUNT_PATH):
+    # 都道府県ごとの推定をプロセスプールで並列に行う
+    counts, dates, names = prefecture.load_count(count_path)
+    windows = prefecture.emergency_windows(dates) if piecewise else [(0, len(dates))]
+    prefectures = prefectures or names
+    tasks = [(i, counts[:, names.index(i)], dates, windows, prefecture.POPULATION[i]) for i in prefectures]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        rows = [row for result in executor.map(_fit_prefecture, tasks) for row in result]
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prefectures", nargs="*", default=None)
+    parser.add_argument("--no_piecewise", action="store_true", help="緊急事態宣言で期間を区切らない")
+    parser.add_argument("--max_workers", type=int, default=None)
+    parser.add_argument("--output", default=OUTPUT)
+    args = parser.parse_args()
+
+    df = fit_all(args.prefectures, not args.no_piecewise, args.max_workers)
+    df.to_csv(args.output, index=False)
+    print(df)
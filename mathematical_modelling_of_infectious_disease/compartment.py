@@ -0,0 +1,156 @@
+"""
+SIR・SEIR モデルを、パラメータの組 P 個ぶんまとめて配列で時間発展させる
+
+状態は [P, 区画] の配列で、区画の並びは COMPARTMENTS の通り
+beta は sir.py・seir.py と同じく人口で割った値 (beta*I(t) が感受性人口 1 人あたりの感染率)
+
+method
+    discrete: sir.py・seir.py の差分方程式 (1 日ごとの前進 Euler。右辺はすべて前日の値で計算する)
+    rk4: 古典的 Runge-Kutta 法 (1 日を substeps 回に分ける)
+    dopri5: Dormand-Prince 法 (刻み幅を誤差に応じて変える。刻み幅は全パラメータの組で共通。atol は人数)
+"""
+import numpy as np
+
+COMPARTMENTS = {"sir": ["S", "I", "R"], "seir": ["S", "E", "I", "R"]}
+
+# Dormand-Prince 5(4) の係数
+DOPRI_A = [
+    [],
+    [1 / 5],
+    [3 / 40, 9 / 40],
+    [44 / 45, -56 / 15, 32 / 9],
+    [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+    [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+    [35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84],
+]
+DOPRI_B5 = np.array([35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84, 0])
+DOPRI_B4 = np.array([5179 / 57600, 0, 7571 / 16695, 393 / 640, -92097 / 339200, 187 / 2100, 1 / 40])
+
+
+def as_params(model, beta, gamma, epsilon=None):
+    # パラメータを [P] の配列にそろえる (スカラーは P 個に広げる)
+    if model == "seir" and epsilon is None:
+        raise ValueError("seir needs epsilon")
+    beta, gamma, epsilon = np.broadcast_arrays(
+        np.asarray(beta, dtype=np.float64),
+        np.asarray(gamma, dtype=np.float64),
+        np.asarray(0.0 if epsilon is None else epsilon, dtype=np.float64),
+    )
+    return np.atleast_1d(beta), np.atleast_1d(gamma), np.atleast_1d(epsilon)
+
+
+def initial_state(model, N, delta, gamma):
+    # sir.py・seir.py と同じ初期値: 検出された 1 人の背後にいる感染者 I = 1 / (delta * gamma)、残りはすべて感受性
+    N, delta, gamma = np.broadcast_arrays(*[np.atleast_1d(np.asarray(i, dtype=np.float64)) for i in [N, delta, gamma]])
+    y0 = np.zeros((len(N), len(COMPARTMENTS[model])))
+    I = 1 / (delta * gamma)
+    y0[:, 0] = N - I
+    y0[:, COMPARTMENTS[model].index("I")] = I
+    return y0
+
+
+def derivative(model, y, beta, gamma, epsilon, out=None):
+    # y: [P, 区画] -> dy/dt: [P, 区画]
+    if out is None:
+        out = np.empty_like(y)
+    if model == "sir":
+        S, I = y[:, 0], y[:, 1]
+        infection = beta * S * I
+        recovery = gamma * I
+        out[:, 0] = -infection
+        out[:, 1] = infection - recovery
+        out[:, 2] = recovery
+    elif model == "seir":
+        S, E, I = y[:, 0], y[:, 1], y[:, 2]
+        infection = beta * S * I
+        onset = epsilon * E
+        recovery = gamma * I
+        out[:, 0] = -infection
+        out[:, 1] = infection - onset
+        out[:, 2] = onset - recovery
+        out[:, 3] = recovery
+    else:
+        raise ValueError(f"unknown model {model!r}")
+    return out
+
+
+def incidence(model, y, beta, gamma, epsilon):
+    # 1 日あたりの新規の感染性 I への流入 ([..., T])。検出率 delta を掛けると報告数のモデル値になる
+    if model == "sir":
+        return beta * y[..., 0] * y[..., 1]
+    return epsilon * y[..., 1]
+
+
+def _step_rk4(model, y, h, params, k):
+    # k: [4, P, 区画] の作業領域
+    derivative(model, y, *params, out=k[0])
+    derivative(model, y + h / 2 * k[0], *params, out=k[1])
+    derivative(model, y + h / 2 * k[1], *params, out=k[2])
+    derivative(model, y + h * k[2], *params, out=k[3])
+    return y + h / 6 * (k[0] + 2 * k[1] + 2 * k[2] + k[3])
+
+
+def _advance_dopri5(model, y, params, h, rtol, atol, k):
+    # y を 1 日ぶん進める。h は前回受理した刻み幅で、次回の初期値として返す
+    t = 0.0
+    while t < 1.0:
+        h = min(h, 1.0 - t)
+        derivative(model, y, *params, out=k[0])
+        for i in range(1, 7):
+            derivative(model, y + h * np.tensordot(DOPRI_A[i], k[:i], axes=1), *params, out=k[i])
+        y5 = y + h * np.tensordot(DOPRI_B5, k, axes=1)
+        y4 = y + h * np.tensordot(DOPRI_B4, k, axes=1)
+        scale = atol + rtol * np.maximum(np.abs(y), np.abs(y5))
+        error = np.sqrt(np.mean(((y5 - y4) / scale) ** 2, axis=1)).max()  # 最も悪いパラメータの組で判定する
+        if error <= 1.0:
+            t += h
+            y = y5
+        h *= min(5.0, max(0.2, 0.9 * (error + 1e-16) ** -0.2))
+    return y, h
+
+
+def simulate(
+    model,
+    beta,
+    gamma,
+    epsilon=None,
+    y0=None,
+    N=126000000,
+    delta=0.25,
+    T=365,
+    method="discrete",
+    substeps=1,
+    rtol=1e-6,
+    atol=1e-3,
+    out=None,
+    Rt_out=None,
+):
+    # 戻り値: (区画の推移 [P, T + 1, 区画], Rt = beta * S / gamma の推移 [P, T + 1])。先頭は初期値
+    # out・Rt_out を渡すとそこに書き込む (シナリオを繰り返すときに確保し直さない)
+    params = as_params(model, beta, gamma, epsilon)
+    if y0 is None:
+        y0 = initial_state(model, N, delta, params[1])
+    P, C = max(len(params[0]), len(y0)), len(COMPARTMENTS[model])
+    params = [np.broadcast_to(i, (P,)) for i in params]
+    y = np.broadcast_to(y0, (P, C)).astype(np.float64)
+    if out is None:
+        out = np.empty((P, T + 1, C))
+    if Rt_out is None:
+        Rt_out = np.empty((P, T + 1))
+    k = np.empty((7, P, C))
+    h = 1.0 / substeps
+    out[:, 0] = y
+    for t in range(1, T + 1):
+        if method == "discrete":
+            y = y + derivative(model, y, *params, out=k[0])
+        elif method == "rk4":
+            for _ in range(substeps):
+                y = _step_rk4(model, y, 1.0 / substeps, params, k)
+        elif method == "dopri5":
+            y, h = _advance_dopri5(model, y, params, h, rtol, atol, k)
+        else:
+            raise ValueError(f"unknown method {method!r}")
+        out[:, t] = y
+    np.multiply(params[0][:, None], out[:, :, 0], out=Rt_out)
+    Rt_out /= params[1][:, None]
+    return out, Rt_out
@@ -0,0 +1,146 @@
+"""
+地域 (都道府県・市区町村) ごとに S/E/I/R を持ち、移動でつながった SEIR モデル (メタ個体群モデル) を、シナリオをまとめて計算する
+
+状態は区画ごとに [地域, シナリオ] の配列
+W は疎な移動行列 (CSR) で、W[i, j] は地域 i の住民が地域 j で過ごす時間の割合 (各行の和は 1)
+地域 i の住民への感染力は beta * sum_j W[i, j] * I_j / N_j で、1 日に 1 回の疎行列と密行列の積で求める
+beta は人口を掛けた値 (seir.py の beta * N) で、差分方程式は compartment.py の discrete と同じ
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.spatial import cKDTree
+
+import prefecture
+from calibrate import smooth
+
+
+def _unit_vectors(coordinates):
+    # (緯度, 経度) [地域, 2] -> 単位球面上の点 [地域, 3]
+    lat, lon = np.radians(np.asarray(coordinates, dtype=np.float64)).T
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=1)
+
+
+def gravity_mobility(population, coordinates, travel=0.05, k=8, exponent=2.0, radius=6371.0):
+    # 重力モデル (流れ ~ 移動先の人口 / 距離 ** exponent) で、各地域から近い k 地域への移動行列を作る
+    # 住民は時間の (1 - travel) を自分の地域で、travel を k 地域で流れに比例して過ごす
+    # 近傍は KD 木で探すので、N×N の距離行列は作らない
+    population = np.asarray(population, dtype=np.float64)
+    n = len(population)
+    k = min(k, n - 1)
+    if k == 0:
+        return sp.identity(n, format="csr")
+    points = _unit_vectors(coordinates)
+    distance, neighbor = cKDTree(points).query(points, k=k + 1)
+    distance, neighbor = distance[:, 1:] * radius, neighbor[:, 1:]  # 弦の長さ (km)。先頭は自分自身
+    flow = population[neighbor] / np.maximum(distance, 1.0) ** exponent
+    flow *= travel / flow.sum(axis=1, keepdims=True)
+    rows = np.concatenate([np.arange(n), np.repeat(np.arange(n), k)])
+    cols = np.concatenate([np.arange(n), neighbor.ravel()])
+    data = np.concatenate([np.full(n, 1.0 - travel), flow.ravel()])
+    W = sp.csr_matrix((data, (rows, cols)), shape=(n, n))
+    W.eliminate_zeros()
+    return W
+
+
+def simulate(W, N, beta, gamma, epsilon, y0, T=365, node_incidence=False):
+    # W: [地域, 地域] 疎な移動行列、N: [地域] 人口、y0: [区画 (S, E, I, R), 地域, シナリオ]
+    # beta は [シナリオ]・[地域, 1]・[地域, シナリオ] のいずれか (スカラーも可)。epsilon・gamma はスカラーか [シナリオ]
+    # 戻り値: (最終状態 [区画, 地域, シナリオ], 全地域の 1 日あたりの I への流入 [T + 1, シナリオ],
+    #          node_incidence なら地域ごとの流入 [T + 1, 地域, シナリオ] も)
+    W = sp.csr_matrix(W)
+    N = np.asarray(N, dtype=np.float64)[:, None]
+    y = np.array(y0, dtype=np.float64)
+    _, n, s = y.shape
+    beta = np.broadcast_to(np.asarray(beta, dtype=np.float64), (n, s))
+    gamma = np.broadcast_to(np.asarray(gamma, dtype=np.float64), (s,))
+    epsilon = np.broadcast_to(np.asarray(epsilon, dtype=np.float64), (s,))
+    S, E, I, R = y
+    prevalence = np.empty((n, s))
+    infection = np.empty((n, s))
+    onset = np.empty((n, s))
+    recovery = np.empty((n, s))
+    incidence = np.zeros((T + 1, s))
+    nodes = np.zeros((T + 1, n, s)) if node_incidence else None
+    for t in range(1, T + 1):
+        np.divide(I, N, out=prevalence)
+        force = W @ prevalence  # 滞在先で触れる感染性の割合を、滞在時間で重み付けした和
+        np.multiply(force, beta, out=infection)
+        infection *= S
+        np.multiply(E, epsilon, out=onset)
+        np.multiply(I, gamma, out=recovery)
+        S -= infection
+        E += infection
+        E -= onset
+        I += onset
+        I -= recovery
+        R += recovery
+        onset.sum(axis=0, out=incidence[t])
+        if node_incidence:
+            nodes[t] = onset
+    if node_incidence:
+        return y, incidence, nodes
+    return y, incidence
+
+
+def initial_state(N, I0, scenarios=1):
+    # I0: [地域] 初期の感染性の人数。残りはすべて感受性
+    N, I0 = np.asarray(N, dtype=np.float64), np.asarray(I0, dtype=np.float64)
+    y0 = np.zeros((4, len(N), scenarios))
+    y0[0] = (N - I0)[:, None]
+    y0[2] = I0[:, None]
+    return y0
+
+
+def observed_initial(prefectures, date, delta, gamma, count_path=prefecture.COUNT_PATH):
+    # count.csv の date の新規感染者数 (7 日平均) から、compartment.initial_state と同じく I = 報告数 / (delta * gamma) とする
+    counts, dates, names = prefecture.load_count(count_path)
+    t = int(np.searchsorted(dates, np.datetime64(date, "D")))
+    if t == len(dates) or dates[t] != np.datetime64(date, "D"):
+        raise ValueError(f"{date} is not in {count_path} (available: {dates[0]} to {dates[-1]})")
+    cases = np.array([smooth(counts[:, names.index(i)])[t] for i in prefectures])
+    return cases / (delta * gamma)
+
+
+if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--start", default="2020-07-01", help="この日の報告数から初期の I を決める")
+    parser.add_argument("--R0", type=float, nargs=2, default=[1.2, 2.6], help="シナリオの R0 の範囲")
+    parser.add_argument("--scenarios", type=int, default=1000)
+    parser.add_argument("--epsilon", type=float, default=0.2)
+    parser.add_argument("--gamma", type=float, default=0.1)
+    parser.add_argument("--delta", type=float, default=0.25)
+    parser.add_argument("--travel", type=float, default=0.05, help="住民が他の地域で過ごす時間の割合")
+    parser.add_argument("--k", type=int, default=8, help="移動先とする近い地域の数")
+    parser.add_argument("--T", type=int, default=180)
+    parser.add_argument("--output", default=None, help="シナリオごとの全国の 1 日あたりの流入を書き出す CSV")
+    args = parser.parse_args()
+
+    prefectures = list(prefecture.COORDINATES)
+    N = np.array([prefecture.POPULATION[i] for i in prefectures])
+    W = gravity_mobility(N, [prefecture.COORDINATES[i] for i in prefectures], args.travel, args.k)
+    R0 = np.linspace(*args.R0, args.scenarios)
+    try:
+        I0 = observed_initial(prefectures, args.start, args.delta, args.gamma)
+    except ValueError as e:
+        parser.error(f"--start {e}")
+    y, incidence, nodes = simulate(
+        W, N, R0 * args.gamma, args.gamma, args.epsilon, initial_state(N, I0, args.scenarios), args.T, node_incidence=True
+    )
+
+    dates = pd.date_range(args.start, periods=args.T + 1)
+    if args.output is not None:
+        pd.DataFrame(incidence, index=dates, columns=[f"R0={i:.3f}" for i in R0]).to_csv(args.output)
+    attack = pd.Series(y[3].T[args.scenarios // 2] / N, index=prefectures).sort_values()
+    print(f"R0={R0[args.scenarios // 2]:.2f} attack rate\n{attack}")
+
+    fig, ax = plt.subplots(1, 2, figsize=(12, 4))
+    ax[0].plot(dates, incidence[:, :: max(args.scenarios // 10, 1)])
+    ax[0].set_title("incidence (all prefectures)")
+    ax[1].plot(dates, nodes[:, :, args.scenarios // 2] / N)
+    ax[1].set_title(f"incidence / N by prefecture (R0={R0[args.scenarios // 2]:.2f})")
+    plt.show()
@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+
+COUNT_PATH = "data/raw/count.csv"
+EMERGENCY_PATH = "data/use/emergency.csv"
+
+# 2020 年国勢調査の人口
+POPULATION = {
+    "Hokkaido": 5224614,
+    "Aomori": 1237984,
+    "Iwate": 1210534,
+    "Miyagi": 2301996,
+    "Akita": 959502,
+    "Yamagata": 1068027,
+    "Fukushima": 1833152,
+    "Ibaraki": 2867009,
+    "Tochigi": 1933146,
+    "Gunma": 1939110,
+    "Saitama": 7344765,
+    "Chiba": 6284480,
+    "Tokyo": 14047594,
+    "Kanagawa": 9237337,
+    "Niigata": 2201272,
+    "Toyama": 1034814,
+    "Ishikawa": 1132526,
+    "Fukui": 766863,
+    "Yamanashi": 809974,
+    "Nagano": 2048011,
+    "Gifu": 1978742,
+    "Shizuoka": 3633202,
+    "Aichi": 7542415,
+    "Mie": 1770254,
+    "Shiga": 1413610,
+    "Kyoto": 2578087,
+    "Osaka": 8837685,
+    "Hyogo": 5465002,
+    "Nara": 1324473,
+    "Wakayama": 922584,
+    "Tottori": 553407,
+    "Shimane": 671126,
+    "Okayama": 1888432,
+    "Hiroshima": 2799702,
+    "Yamaguchi": 1342059,
+    "Tokushima": 719559,
+    "Kagawa": 950244,
+    "Ehime": 1334841,
+    "Kochi": 691527,
+    "Fukuoka": 5135214,
+    "Saga": 811442,
+    "Nagasaki": 1312317,
+    "Kumamoto": 1738301,
+    "Oita": 1123852,
+    "Miyazaki": 1069576,
+    "Kagoshima": 1588256,
+    "Okinawa": 1467480,
+}
+POPULATION["ALL"] = sum(POPULATION.values())
+
+# 都道府県庁所在地の (緯度, 経度)
+COORDINATES = {
+    "Hokkaido": (43.06, 141.35),
+    "Aomori": (40.82, 140.74),
+    "Iwate": (39.70, 141.15),
+    "Miyagi": (38.27, 140.87),
+    "Akita": (39.72, 140.10),
+    "Yamagata": (38.24, 140.36),
+    "Fukushima": (37.75, 140.47),
+    "Ibaraki": (36.34, 140.45),
+    "Tochigi": (36.57, 139.88),
+    "Gunma": (36.39, 139.06),
+    "Saitama": (35.86, 139.65),
+    "Chiba": (35.61, 140.12),
+    "Tokyo": (35.69, 139.69),
+    "Kanagawa": (35.45, 139.64),
+    "Niigata": (37.90, 139.02),
+    "Toyama": (36.70, 137.21),
+    "Ishikawa": (36.59, 136.63),
+    "Fukui": (36.07, 136.22),
+    "Yamanashi": (35.66, 138.57),
+    "Nagano": (36.65, 138.18),
+    "Gifu": (35.39, 136.72),
+    "Shizuoka": (34.98, 138.38),
+    "Aichi": (35.18, 136.91),
+    "Mie": (34.73, 136.51),
+    "Shiga": (35.00, 135.87),
+    "Kyoto": (35.02, 135.76),
+    "Osaka": (34.69, 135.52),
+    "Hyogo": (34.69, 135.18),
+    "Nara": (34.69, 135.83),
+    "Wakayama": (34.23, 135.17),
+    "Tottori": (35.50, 134.24),
+    "Shimane": (35.47, 133.05),
+    "Okayama": (34.66, 133.93),
+    "Hiroshima": (34.40, 132.46),
+    "Yamaguchi": (34.19, 131.47),
+    "Tokushima": (34.07, 134.56),
+    "Kagawa": (34.34, 134.04),
+    "Ehime": (33.84, 132.77),
+    "Kochi": (33.56, 133.53),
+    "Fukuoka": (33.61, 130.42),
+    "Saga": (33.25, 130.30),
+    "Nagasaki": (32.74, 129.87),
+    "Kumamoto": (32.79, 130.74),
+    "Oita": (33.24, 131.61),
+    "Miyazaki": (31.91, 131.42),
+    "Kagoshima": (31.56, 130.56),
+    "Okinawa": (26.21, 127.68),
+}
+
+
+def load_count(path=COUNT_PATH):
+    # 縦持ちの count.csv (Date, Prefecture, Newly confirmed cases) を 日付×都道府県 の行列にする
+    # 戻り値: (counts [T, 都道府県], dates [T] datetime64[D], prefectures)。列の並びはファイルに現れた順 (先頭は ALL)
+    df = pd.read_csv(path, encoding="utf-8-sig")
+    df.columns = ["Date", "Prefecture", "count"]
+    prefectures = list(pd.unique(df["Prefecture"]))
+    df["Date"] = pd.to_datetime(df["Date"])
+    df = df.pivot(index="Date", columns="Prefecture", values="count")[prefectures]
+    df = df.asfreq("D")  # 抜けている日があれば NaN の行を入れる
+    return df.values.astype(np.float64), df.index.values.astype("datetime64[D]"), prefectures
+
+
+def load_emergency(path=EMERGENCY_PATH):
+    # 緊急事態宣言の期間中なら True の配列と日付を返す (emergency.csv は宣言からの日数で、期間外は 0)
+    df = pd.read_csv(path, index_col=0, parse_dates=True)
+    return df.iloc[:, 0].values > 0, df.index.values.astype("datetime64[D]")
+
+
+def emergency_windows(dates, path=EMERGENCY_PATH):
+    # dates を緊急事態宣言の開始・終了の日で区切り、各区間の [start, end) の添字を返す
+    emergency, emergency_dates = load_emergency(path)
+    flag = np.zeros(len(dates), dtype=bool)
+    idx = np.searchsorted(emergency_dates, dates)
+    valid = (idx < len(emergency_dates)) & (emergency_dates[np.minimum(idx, len(emergency_dates) - 1)] == dates)
+    flag[valid] = emergency[idx[valid]]
+    breaks = np.flatnonzero(flag[1:] != flag[:-1]) + 1
+    bounds = np.concatenate([[0], breaks, [len(dates)]])
+    return [(int(i), int(j)) for i, j in zip(bounds[:-1], bounds[1:])]
@@ -1,6 +1,8 @@
 #%%
 import matplotlib.pyplot as plt
 
+import compartment
+
 """
 S(t): 感受性
 E(t): 潜伏期
@@ -25,50 +27,12 @@ N = 126000000  # 日本の人口
 beta = 0.26 / N
 epsilon = 0.2
 gamma = 0.1
-R0 = beta / gamma
 delta = 0.25  # 検出率
 
-I = 1 / (delta * gamma)
-S = N - I
-E = 0
-R = 0
-
-aS = [S]
-aE = [E]
-aI = [I]
-aR = [R]
-aRt = [R0]
-
-
-def calc_S(S, E, I, R):
-    return S - beta * S * I
-
-
-def calc_E(S, E, I, R):
-    return E + beta * S * I - epsilon * E
-
-
-def calc_I(S, E, I, R):
-    return I + epsilon * E - gamma * I
-
-
-def calc_R(S, E, I, R):
-    return R + gamma * I
-
-
-for t in range(365):
-    S, E, I, R = (
-        calc_S(S, E, I, R),
-        calc_E(S, E, I, R),
-        calc_I(S, E, I, R),
-        calc_R(S, E, I, R),
-    )
-    Rt = beta * S / gamma
-    aS.append(S)
-    aE.append(E)
-    aI.append(I)
-    aR.append(R)
-    aRt.append(Rt)
+# 状態の推移は compartment.simulate で計算する (パラメータを配列にすれば複数のシナリオをまとめて計算できる)
+out, Rt = compartment.simulate("seir", beta, gamma, epsilon, N=N, delta=delta, T=365)
+aS, aE, aI, aR = out[0].T
+aRt = Rt[0]
 
 plt.plot(aS, label="S")
 plt.plot(aE, label="E")
@@ -3,6 +3,8 @@
 
 import matplotlib.pyplot as plt
 
+import compartment
+
 """
 S(t): 感受性
 I(t): 感染性
@@ -22,38 +24,12 @@ dR(t)/dt = gamma*I(t)
 N = 126000000  # 日本の人口
 beta = 0.26 / N
 gamma = 0.1
-R0 = beta / gamma
 delta = 0.25  # 検出率
 
-I = 1 / (delta * gamma)
-S = N - I
-R = 0
-
-aS = [S]
-aI = [I]
-aR = [R]
-aRt = [R0]
-
-
-def calc_S(S, I, R):
-    return S - beta * S * I
-
-
-def calc_I(S, I, R):
-    return I + beta * S * I - gamma * I
-
-
-def calc_R(S, I, R):
-    return R + gamma * I
-
-
-for t in range(365):
-    S, I, R = calc_S(S, I, R), calc_I(S, I, R), calc_R(S, I, R)
-    Rt = beta * S / gamma
-    aS.append(S)
-    aI.append(I)
-    aR.append(R)
-    aRt.append(Rt)
+# 状態の推移は compartment.simulate で計算する (パラメータを配列にすれば複数のシナリオをまとめて計算できる)
+out, Rt = compartment.simulate("sir", beta, gamma, N=N, delta=delta, T=365)
+aS, aI, aR = out[0].T
+aRt = Rt[0]
 
 plt.plot(aS, label="S")
 plt.plot(aI, label="I")
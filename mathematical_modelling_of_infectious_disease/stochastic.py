@@ -0,0 +1,218 @@
+"""
+SIR・SEIR モデルの確率的なシミュレーション (tau-leaping) を、試行 (replicate) をまとめて配列で行う
+
+区画は compartment.py と同じで、状態は [試行, 区画] の整数の配列
+1 日を substeps 回に分け、各遷移の人数を
+    binomial: 区画の人数を上限とする二項分布 (確率は 1 - exp(-率 * 刻み幅))
+    poisson: 平均 率 * 人数 * 刻み幅 の Poisson 分布 (区画の人数で打ち切る)
+から引く
+
+試行の軌跡は保存せず、日ごとの値を QuantileSketch (対数の幅のヒストグラム) に足していき、そこからパーセンタイルを求める
+乱数は SeedSequence を試行のかたまり (chunk) ごとに spawn するので、並列数を変えても結果は同じ
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import calibrate
+import compartment
+import prefecture
+
+
+class QuantileSketch:
+    # T 日ぶんの、日ごとの値の分布を表すヒストグラム
+    # 0 は専用の区間、1 以上は 10 を bins_per_decade 個に分けた対数の区間に数える (相対誤差は 10 ** (1 / bins_per_decade) - 1 以下)
+    # 同じ形のものどうしは足し合わせられる (merge)
+    def __init__(self, T, max_value, bins_per_decade=200):
+        self.bins_per_decade = bins_per_decade
+        self.num_bins = 2 + int(np.ceil(np.log10(max(max_value, 1)) * bins_per_decade))
+        self.counts = np.zeros((T, self.num_bins), dtype=np.int64)
+
+    def bin(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        idx = np.zeros(values.shape, dtype=np.int64)
+        positive = values >= 1
+        idx[positive] = 1 + (np.log10(values[positive]) * self.bins_per_decade).astype(np.int64)
+        return np.minimum(idx, self.num_bins - 1)
+
+    def update(self, t, values):
+        # values: [試行] t 日目の値
+        self.counts[t] += np.bincount(self.bin(values), minlength=self.num_bins)
+
+    def merge(self, other):
+        if self.counts.shape != other.counts.shape or self.bins_per_decade != other.bins_per_decade:
+            raise ValueError("sketches have different shapes")
+        self.counts += other.counts
+        return self
+
+    def quantile(self, q):
+        # 戻り値: [T] 各日の q 分位点 (区間の幾何平均。区間の幅が 1 より狭い小さな値は整数に丸める)
+        cumsum = np.cumsum(self.counts, axis=1)
+        rank = np.ceil(q * cumsum[:, -1]).clip(min=1)
+        idx = (cumsum < rank[:, None]).sum(axis=1)
+        value = 10 ** ((idx - 0.5) / self.bins_per_decade)
+        value = np.where(value < 1 / (10 ** (1 / self.bins_per_decade) - 1), np.round(value), value)
+        return np.where(idx == 0, 0.0, value)
+
+
+def _transition(rng, n, rate, h, method):
+    # n 人それぞれが率 rate で遷移するとき、刻み幅 h の間に遷移する人数
+    if method == "binomial":
+        return rng.binomial(n, -np.expm1(-rate * h))
+    elif method == "poisson":
+        return np.minimum(rng.poisson(rate * n * h), n)
+    raise ValueError(f"unknown method {method!r}")
+
+
+def simulate_stochastic(
+    model,
+    beta,
+    gamma,
+    epsilon=None,
+    y0=None,
+    N=126000000,
+    delta=0.25,
+    T=365,
+    replicates=1000,
+    rng=None,
+    method="binomial",
+    substeps=1,
+    bins_per_decade=200,
+):
+    # 戻り値: ({系列名: QuantileSketch}, 最終状態 [試行, 区画])
+    # 系列は各区画の人数と、1 日あたりの I への流入 (incidence) とそのうち検出される人数 (cases)
+    # パラメータはスカラーか [試行] の配列
+    rng = np.random.default_rng(rng)
+    beta, gamma, epsilon = [np.broadcast_to(i, (replicates,)) for i in compartment.as_params(model, beta, gamma, epsilon)]
+    if y0 is None:
+        y0 = np.round(compartment.initial_state(model, N, delta, gamma[:1]))
+    y = np.broadcast_to(np.asarray(y0, dtype=np.int64), (replicates, len(compartment.COMPARTMENTS[model]))).copy()
+    max_value = y.sum(axis=1).max()
+    names = compartment.COMPARTMENTS[model] + ["incidence", "cases"]
+    sketches = {name: QuantileSketch(T + 1, max_value, bins_per_decade) for name in names}
+
+    def record(t, incidence):
+        for c, name in enumerate(compartment.COMPARTMENTS[model]):
+            sketches[name].update(t, y[:, c])
+        sketches["incidence"].update(t, incidence)
+        sketches["cases"].update(t, rng.binomial(incidence, delta))
+
+    h = 1.0 / substeps
+    record(0, np.zeros(replicates, dtype=np.int64))
+    for t in range(1, T + 1):
+        incidence = np.zeros(replicates, dtype=np.int64)
+        for _ in range(substeps):
+            S, I = y[:, 0], y[:, -2]
+            infection = _transition(rng, S, beta * I, h, method)
+            recovery = _transition(rng, I, gamma, h, method)
+            if model == "seir":
+                onset = _transition(rng, y[:, 1], epsilon, h, method)
+                y[:, 1] += infection - onset
+            else:
+                onset = infection
+            y[:, 0] -= infection
+            y[:, -2] += onset - recovery
+            y[:, -1] += recovery
+            incidence += onset
+        record(t, incidence)
+    return sketches, y
+
+
+def _run_chunk(kwargs):
+    sketches, y = simulate_stochastic(**kwargs)
+    # 流行が終わった (E・I が 0 になった) 試行の数
+    return sketches, int((y[:, 1:-1].sum(axis=1) == 0).sum())
+
+
+def run(model, beta, gamma, epsilon=None, replicates=10000, chunk_size=1000, max_workers=None, seed=0, **kwargs):
+    # replicates 回の試行を chunk_size ずつに分けてプロセスプールで実行し、sketch を足し合わせる
+    # 戻り値: ({系列名: QuantileSketch}, 流行が終わった試行の割合)
+    sizes = [min(chunk_size, replicates - i) for i in range(0, replicates, chunk_size)]
+    streams = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [
+        dict(model=model, beta=beta, gamma=gamma, epsilon=epsilon, replicates=size, rng=stream, **kwargs)
+        for size, stream in zip(sizes, streams)
+    ]
+    sketches, extinct = None, 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for chunk, n in executor.map(_run_chunk, tasks):
+            sketches = chunk if sketches is None else {k: v.merge(chunk[k]) for k, v in sketches.items()}
+            extinct += n
+    return sketches, extinct / replicates
+
+
+def fitted_initial(model, rows, N):
+    # calibrate.py の推定結果 (1 都道府県ぶんの行) で最後の期間の終わりまで進めた状態を、model の区画の人数にする
+    # SIR では E を I に含める
+    s, e, i = calibrate.fitted_state(rows, N)
+    S, E, I = np.round(N * np.array([s, e, i]))
+    y0 = [S, E, I] if model == "seir" else [S, E + I]
+    return np.array(y0 + [N - sum(y0)])
+
+
+def bands(sketches, percentiles=(2.5, 25, 50, 75, 97.5)):
+    # {系列名: QuantileSketch} -> 列が (系列名, パーセンタイル) の DataFrame
+    return pd.DataFrame({(name, p): sketch.quantile(p / 100) for name, sketch in sketches.items() for p in percentiles})
+
+
+if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", choices=["sir", "seir"], default="seir")
+    parser.add_argument("--prefecture", default="ALL", help="人口を使う都道府県")
+    parser.add_argument("--fit", default=None, help="calibrate.py の出力。指定するとその都道府県の最後の期間のパラメータを使う")
+    parser.add_argument("--beta", type=float, default=0.26, help="人口を掛けた値")
+    parser.add_argument("--epsilon", type=float, default=0.2)
+    parser.add_argument("--gamma", type=float, default=0.1)
+    parser.add_argument("--delta", type=float, default=0.25)
+    parser.add_argument("--T", type=int, default=365)
+    parser.add_argument("--replicates", type=int, default=10000)
+    parser.add_argument("--chunk_size", type=int, default=1000)
+    parser.add_argument("--max_workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--method", choices=["binomial", "poisson"], default="binomial")
+    parser.add_argument("--substeps", type=int, default=1)
+    parser.add_argument("--output", default=None, help="パーセンタイルの表を書き出す CSV")
+    args = parser.parse_args()
+
+    N = prefecture.POPULATION[args.prefecture]
+    beta, epsilon, gamma, delta = args.beta / N, args.epsilon, args.gamma, args.delta
+    y0 = None
+    if args.fit is not None:
+        fit = pd.read_csv(args.fit)
+        rows = fit[fit["prefecture"] == args.prefecture]
+        if rows.empty:
+            parser.error(f"{args.prefecture} is not in {args.fit}")
+        beta, epsilon, gamma, delta = rows.iloc[-1][["beta", "epsilon", "gamma", "delta"]]
+        # 既定の初期値 (報告 1 人ぶんの I) ではなく、推定したモデルの最後の期間の翌日の状態から始める
+        y0 = fitted_initial(args.model, rows, N)
+
+    sketches, extinct = run(
+        args.model,
+        beta,
+        gamma,
+        epsilon,
+        replicates=args.replicates,
+        chunk_size=args.chunk_size,
+        max_workers=args.max_workers,
+        seed=args.seed,
+        y0=y0,
+        N=N,
+        delta=delta,
+        T=args.T,
+        method=args.method,
+        substeps=args.substeps,
+    )
+    df = bands(sketches)
+    print(f"extinct: {extinct:.3f}")
+    if args.output is not None:
+        df.to_csv(args.output)
+
+    plt.fill_between(df.index, df[("I", 2.5)], df[("I", 97.5)], alpha=0.2, label="I 95%")
+    plt.fill_between(df.index, df[("I", 25)], df[("I", 75)], alpha=0.4, label="I 50%")
+    plt.plot(df[("I", 50)], label="I median")
+    plt.legend()
+    plt.show()